@@ -0,0 +1,97 @@
+"""Compare beam matching with the exhaustive search on synthetic networks.
+
+Run from the repository root with network_topology importable:
+
+    python benchmarks/beam.py --size small --candidates 2 4 8 --beams 2 4 8
+
+Each network is built once and its routes are matched exhaustively and
+then with every combination of maxCandidates and beamWidth. For each
+setting, the fraction of routes matched to exactly the same edges, the
+mean Jaccard index of the matched edge sets and the routes matched per
+second are printed, and written as JSON with --output.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+import time
+
+import network_topology
+from synthetic import GENERATORS, SIZES
+
+
+def matchAll(graph, lines, **kwargs):
+    """Match every route with a fresh matcher, returning paths and time."""
+    matcher = network_topology.TopologyMatcher(graph, **kwargs)
+    start = time.time()
+    paths = dict((k, matcher.match(ls)) for k, ls in lines.items())
+    return paths, time.time() - start
+
+
+def quality(paths, exact):
+    """Return the fraction of identical paths and the mean edge Jaccard."""
+    same = 0
+    jaccard = 0.
+    for k, path in exact.items():
+        same += paths[k] == path
+        a, b = set(paths[k]), set(path)
+        jaccard += len(a & b) / float(len(a | b)) if a | b else 1.
+    return same / float(len(exact)), jaccard / len(exact)
+
+
+def runCase(name, kwargs, seed, candidates, beams):
+    """Sweep the beam settings on one synthetic network."""
+    lines = GENERATORS[name](seed=seed, **kwargs)
+    graph = network_topology.RoutingGraph(
+        network_topology.getNetworkTopology(lines.values()))
+    exact, seconds = matchAll(graph, lines)
+    settings = [{'maxCandidates': None, 'beamWidth': None,
+                 'identical': 1., 'jaccard': 1.,
+                 'routesPerSecond': len(lines) / seconds}]
+    for k in candidates:
+        for b in beams:
+            paths, seconds = matchAll(graph, lines, maxCandidates=k,
+                                      beamWidth=b)
+            identical, jaccard = quality(paths, exact)
+            settings.append({'maxCandidates': k, 'beamWidth': b,
+                             'identical': identical, 'jaccard': jaccard,
+                             'routesPerSecond': len(lines) / seconds})
+    return {'case': name, 'params': dict(kwargs, seed=seed),
+            'routes': len(lines), 'settings': settings}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', choices=sorted(SIZES), default='small')
+    parser.add_argument('--cases', nargs='+', choices=sorted(GENERATORS),
+                        default=sorted(GENERATORS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--candidates', nargs='+', type=int,
+                        default=[2, 4, 8], help='values of maxCandidates')
+    parser.add_argument('--beams', nargs='+', type=int, default=[2, 4, 8],
+                        help='values of beamWidth')
+    parser.add_argument('--output', help='write results to this JSON file')
+    args = parser.parse_args(argv)
+
+    results = {'size': args.size, 'cases': []}
+    for name in args.cases:
+        result = runCase(name, SIZES[args.size][name], args.seed,
+                         args.candidates, args.beams)
+        results['cases'].append(result)
+        print('{case}: {routes} routes'.format(**result))
+        for s in result['settings']:
+            print('  k={!s:<5} B={!s:<5} identical {:6.1%}  jaccard {:.3f}  '
+                  '{:8.1f} routes/s'.format(
+                      s['maxCandidates'], s['beamWidth'], s['identical'],
+                      s['jaccard'], s['routesPerSecond']))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
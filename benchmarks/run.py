@@ -0,0 +1,126 @@
+"""Benchmark building and matching topologies of synthetic networks.
+
+Run from the repository root with network_topology importable:
+
+    python benchmarks/run.py --size small --output results.json
+    python benchmarks/run.py --size small --baseline results.json
+
+Every stage of getNetworkTopology is timed with PipelineStats, and the
+routes of each network are then matched back onto its graph. Results are
+written as JSON; given a baseline written by an earlier run on the same
+machine, stages that got slower by more than the threshold are listed and
+the exit status is 1.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import network_topology
+from synthetic import GENERATORS, SIZES
+
+# Stages faster than this in the baseline are too noisy to compare.
+MIN_SECONDS = 0.05
+
+
+def runCase(name, kwargs, seed, workers):
+    """Build and match one synthetic network, returning its results."""
+    lines = GENERATORS[name](seed=seed, **kwargs)
+    stats = network_topology.PipelineStats()
+    start = time.time()
+    graph = network_topology.getNetworkTopology(lines.values(), stats=stats)
+    build = time.time() - start
+
+    matchStats = network_topology.PipelineStats()
+    start = time.time()
+    network_topology.getMatchedRoutes(lines, graph, workers=workers,
+                                      stats=matchStats)
+    match = time.time() - start
+
+    stages = stats.totals()
+    stages['match'] = matchStats.totals().get('match', {'runs': 0})
+    stages['match']['seconds'] = match
+    return {'case': name,
+            'params': dict(kwargs, seed=seed),
+            'routes': len(lines),
+            'vertices': sum(len(ls.coords) for ls in lines.values()),
+            'buildSeconds': build,
+            'matchSeconds': match,
+            'routesPerSecond': len(lines) / match if match else None,
+            'stages': stages}
+
+
+def compare(results, baseline, threshold):
+    """List the stages that are slower than in the baseline by threshold.
+
+    Changes in the size of the output graph are listed too, since they
+    usually mean the timings are not comparable.
+    """
+    old = dict((r['case'], r) for r in baseline['cases'])
+    problems = []
+    for result in results['cases']:
+        before = old.get(result['case'])
+        if before is None or before['params'] != result['params']:
+            continue
+        for stage, now in result['stages'].items():
+            then = before['stages'].get(stage)
+            if then is None:
+                continue
+            if then['seconds'] >= MIN_SECONDS and \
+                    now['seconds'] > then['seconds'] * threshold:
+                problems.append('{} {}: {:.3f}s, was {:.3f}s'.format(
+                    result['case'], stage, now['seconds'], then['seconds']))
+        now = result['stages'].get('simplify', {}).get('edges')
+        then = before['stages'].get('simplify', {}).get('edges')
+        if now != then:
+            problems.append('{}: {} edges, was {}'.format(
+                result['case'], now, then))
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', choices=sorted(SIZES), default='small')
+    parser.add_argument('--cases', nargs='+', choices=sorted(GENERATORS),
+                        default=sorted(GENERATORS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes for matching')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='compare with this results file')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown ratio that counts as a regression')
+    args = parser.parse_args(argv)
+
+    results = {'size': args.size,
+               'python': platform.python_version(),
+               'machine': platform.machine(),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'cases': []}
+    for name in args.cases:
+        result = runCase(name, SIZES[args.size][name], args.seed,
+                         args.workers)
+        results['cases'].append(result)
+        print('{case}: {routes} routes, build {buildSeconds:.2f}s, '
+              'match {matchSeconds:.2f}s'.format(**result))
+        for stage, total in result['stages'].items():
+            print('  {:<12} {:8.3f}s'.format(stage, total['seconds']))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+    if args.baseline:
+        with open(args.baseline) as fp:
+            problems = compare(results, json.load(fp), args.threshold)
+        for problem in problems:
+            print('REGRESSION', problem)
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,132 @@
+"""Seeded generators of synthetic route networks for the benchmarks.
+
+Every generator returns a dict of route id to LineString in projected
+metres, placed at a UTM-like offset. The same arguments always give the
+same routes.
+"""
+
+import math
+import random
+from shapely.geometry import LineString
+
+ORIGIN = (500000.0, 4800000.0)
+
+
+def gridCity(blocks=10, spacing=150.0, routes=40, jitter=2.0, seed=0):
+    """Routes along the streets of a square grid of `blocks` blocks a side.
+
+    Each route walks from one edge of the grid towards the opposite edge,
+    taking random turns, so that many routes share each street. Vertices
+    are moved by up to `jitter` metres, as GPS traces would be.
+    """
+    rng = random.Random(seed)
+    lines = {}
+    for r in range(routes):
+        # Start on the west or south edge and head east or north.
+        if rng.random() < 0.5:
+            i, j, di, dj = 0, rng.randint(0, blocks), 1, 0
+        else:
+            i, j, di, dj = rng.randint(0, blocks), 0, 0, 1
+        nodes = [(i, j)]
+        while 0 <= i + di <= blocks and 0 <= j + dj <= blocks:
+            i, j = i + di, j + dj
+            nodes.append((i, j))
+            if rng.random() < 0.2:
+                # Turn left or right onto the cross street.
+                side = rng.choice([-1, 1])
+                di, dj = -dj * side, di * side
+                if not (0 <= i + di <= blocks and 0 <= j + dj <= blocks):
+                    di, dj = -di, -dj
+                if (i + di, j + dj) in nodes:
+                    break
+        if len(nodes) < 2:
+            continue
+        lines['grid-{}'.format(r)] = LineString(
+            [_jitter(rng, i * spacing, j * spacing, jitter)
+             for i, j in nodes])
+    return lines
+
+
+def trunkCorridor(length=10000.0, branches=8, variants=60, jitter=2.0,
+                  seed=0):
+    """Many overlapping route variants along one long trunk corridor.
+
+    The trunk runs east with a gentle curve and has `branches` side roads.
+    Each variant joins the trunk at a random point, possibly from a
+    branch, follows it and leaves it again further along, so the trunk is
+    covered by many nearly identical lines.
+    """
+    rng = random.Random(seed)
+    step = 50.0
+
+    def trunk(d):
+        return d, 300.0 * math.sin(d / length * 2.0 * math.pi)
+
+    stops = sorted(rng.uniform(0.0, length) for _ in range(branches))
+    sides = [rng.choice([-1, 1]) * rng.uniform(300.0, 1000.0)
+             for _ in stops]
+    lines = {}
+    for r in range(variants):
+        a, b = sorted(rng.uniform(0.0, length) for _ in range(2))
+        coords = []
+        if stops and rng.random() < 0.5:
+            # Come in along a side road.
+            k = rng.randrange(branches)
+            a, b = stops[k], max(b, stops[k])
+            x, y = trunk(a)
+            coords.append((x, y + sides[k]))
+        d = a
+        while d < b:
+            coords.append(trunk(d))
+            d += step
+        coords.append(trunk(b))
+        if len(coords) < 2:
+            continue
+        lines['trunk-{}'.format(r)] = LineString(
+            [_jitter(rng, x, y, jitter) for x, y in coords])
+    return lines
+
+
+def ruralLines(count=10, length=20000.0, vertexSpacing=25.0, seed=0):
+    """Long, gently winding lines across open country.
+
+    Lines start at random points along the western side of the area and
+    wander east, so they cross only now and then. They have many
+    vertices, as traced rural roads do.
+    """
+    rng = random.Random(seed)
+    lines = {}
+    for r in range(count):
+        x, y = 0.0, rng.uniform(0.0, length / 2.0)
+        heading = rng.uniform(-0.3, 0.3)
+        coords = [(x, y)]
+        while x < length:
+            heading += rng.gauss(0.0, 0.05)
+            heading = max(-0.8, min(0.8, heading))
+            x += vertexSpacing * math.cos(heading)
+            y += vertexSpacing * math.sin(heading)
+            coords.append((x, y))
+        lines['rural-{}'.format(r)] = LineString(
+            [_jitter(rng, x, y, 0.0) for x, y in coords])
+    return lines
+
+
+def _jitter(rng, x, y, amount):
+    return (ORIGIN[0] + x + rng.uniform(-amount, amount),
+            ORIGIN[1] + y + rng.uniform(-amount, amount))
+
+
+GENERATORS = {'grid': gridCity, 'trunk': trunkCorridor, 'rural': ruralLines}
+
+# Arguments for each generator at each suite size.
+SIZES = {
+    'small': {'grid': {'blocks': 6, 'routes': 20},
+              'trunk': {'length': 4000.0, 'branches': 4, 'variants': 20},
+              'rural': {'count': 4, 'length': 5000.0}},
+    'medium': {'grid': {'blocks': 15, 'routes': 120},
+               'trunk': {'length': 15000.0, 'branches': 12, 'variants': 150},
+               'rural': {'count': 15, 'length': 20000.0}},
+    'large': {'grid': {'blocks': 40, 'routes': 800},
+              'trunk': {'length': 50000.0, 'branches': 40, 'variants': 1000},
+              'rural': {'count': 60, 'length': 60000.0}},
+}
@@ -1,2 +1,11 @@
 from .topo import getNetworkTopology
-from .match import getMatchedRoutes
+from .match import getMatchedRoutes, TopologyMatcher, PathCache
+from .tiling import getTiledNetworkTopology
+from .hierarchy import ContractionHierarchy
+from .routing import RoutingGraph
+from .update import updateNetworkTopology
+from .sources import readLineStrings
+from .stagecache import StageCache
+from .instrument import PipelineStats
+from .storage import saveTopology, loadTopology, loadRoutingGraph
+from .online import OnlineMatcher
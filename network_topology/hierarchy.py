@@ -0,0 +1,263 @@
+"""Module for contraction-hierarchy route queries on the simplified graph."""
+
+from itertools import count
+from heapq import heappush, heappop
+import networkx as nx
+import numpy as np
+import logging
+
+logger = logging.getLogger('network-topology')
+
+# Limits on the local searches used to look for witness paths while
+# contracting. Stopping early only adds shortcuts that were not needed.
+WITNESS_SETTLE_LIMIT = 60
+
+
+class ContractionHierarchy:
+    """Contraction hierarchy over the edge lengths of a MultiDiGraph.
+
+    Build it once for a finished graph from getNetworkTopology, save it
+    next to the graph, and set it as DG.graph['hierarchy'] (or pass it to
+    TopologyMatcher) so that route distances for matching are answered
+    from the hierarchy instead of with A* searches. Paths are unpacked to
+    the original (u, v, key) edges and are shortest paths; where several
+    paths tie, the one returned may differ from A*'s.
+    """
+
+    def __init__(self, DG=None, weight='length'):
+        """Initialize, contracting DG if it is given."""
+        self.nodes = []
+        self.ids = {}
+        self.arcs = {}
+        self.rank = []
+        self.up = []
+        self.down = []
+        if DG is not None:
+            self._build(DG, weight)
+
+    def _build(self, DG, weight):
+        logger.info('Building contraction hierarchy')
+        self.nodes = list(DG.nodes())
+        self.ids = dict((n, i) for i, n in enumerate(self.nodes))
+        n = len(self.nodes)
+        out = [{} for _ in range(n)]
+        inn = [{} for _ in range(n)]
+        for u, v, key, data in DG.edges(keys=True, data=True):
+            a, b = self.ids[u], self.ids[v]
+            w = data.get(weight, 1)
+            if a == b or (b in out[a] and out[a][b] <= w):
+                continue
+            out[a][b] = w
+            inn[b][a] = w
+            self.arcs[a, b] = (w, -1, key)
+
+        rank = [None] * n
+        heap = []
+        for x in range(n):
+            heappush(heap, (self._priority(x, out, inn, 0), x))
+        contracted = [0] * n
+        order = 0
+        while heap:
+            _, x = heappop(heap)
+            if rank[x] is not None:
+                continue
+            priority = self._priority(x, out, inn, contracted[x])
+            if heap and priority > heap[0][0]:
+                heappush(heap, (priority, x))
+                continue
+            for u, w, dist in self._shortcuts(x, out, inn):
+                out[u][w] = dist
+                inn[w][u] = dist
+                self.arcs[u, w] = (dist, x, None)
+            for u in inn[x]:
+                del out[u][x]
+                contracted[u] += 1
+            for w in out[x]:
+                del inn[w][x]
+                contracted[w] += 1
+            out[x] = {}
+            inn[x] = {}
+            rank[x] = order
+            order += 1
+        self.rank = rank
+        self._buildSearchGraphs()
+        logger.info('Contraction hierarchy complete')
+
+    def _priority(self, x, out, inn, contracted):
+        shortcuts = len(self._shortcuts(x, out, inn))
+        return shortcuts - len(out[x]) - len(inn[x]) + contracted
+
+    def _shortcuts(self, x, out, inn):
+        """Return the shortcuts needed to contract x, as (u, w, dist)."""
+        shortcuts = []
+        if not inn[x] or not out[x]:
+            return shortcuts
+        longest = max(out[x].values())
+        for u, wu in inn[x].items():
+            limit = wu + longest
+            witness = self._witness(u, x, limit, out)
+            for w, ww in out[x].items():
+                if w == u:
+                    continue
+                dist = wu + ww
+                if witness.get(w, float('inf')) > dist:
+                    shortcuts.append((u, w, dist))
+        return shortcuts
+
+    def _witness(self, source, excluded, limit, out):
+        dists = {source: 0}
+        settled = 0
+        queue = [(0, source)]
+        while queue and settled < WITNESS_SETTLE_LIMIT:
+            dist, node = heappop(queue)
+            if dist > limit:
+                break
+            if dist > dists[node]:
+                continue
+            settled += 1
+            for v, w in out[node].items():
+                if v == excluded:
+                    continue
+                ncost = dist + w
+                if v not in dists or ncost < dists[v]:
+                    dists[v] = ncost
+                    heappush(queue, (ncost, v))
+        return dists
+
+    def _buildSearchGraphs(self):
+        n = len(self.nodes)
+        self.up = [[] for _ in range(n)]
+        self.down = [[] for _ in range(n)]
+        for (u, v), (w, _, __) in sorted(self.arcs.items()):
+            if self.rank[v] > self.rank[u]:
+                self.up[u].append((v, w))
+            else:
+                self.down[v].append((u, w))
+
+    def _search(self, source, graph, cutoff=float('inf'), other=None):
+        """Dijkstra search over one direction of the hierarchy.
+
+        With `other` (the distances of a finished search from the opposite
+        end), stop once no meeting node could beat the best found so far
+        or cutoff, and also return that best (distance, node).
+        """
+        dists = {source: 0}
+        parents = {source: None}
+        best = (float('inf'), None)
+        c = count()
+        queue = [(0, next(c), source)]
+        while queue:
+            dist, _, node = heappop(queue)
+            if dist > dists[node]:
+                continue
+            if other is not None:
+                if dist >= min(cutoff, best[0]):
+                    break
+                if node in other and dist + other[node] < best[0]:
+                    best = (dist + other[node], node)
+            for v, w in graph[node]:
+                ncost = dist + w
+                if v not in dists or ncost < dists[v]:
+                    dists[v] = ncost
+                    parents[v] = node
+                    heappush(queue, (ncost, next(c), v))
+        return dists, parents, best
+
+    def distance(self, source, target):
+        """Return the shortest route distance from source to target."""
+        s, t = self.ids[source], self.ids[target]
+        if s == t:
+            return 0
+        forward, _, __ = self._search(s, self.up)
+        return self._search(t, self.down, other=forward)[2][0]
+
+    def query(self, source, target):
+        """Return the shortest route from source to target as edges.
+
+        Raises NetworkXNoPath if target cannot be reached from source.
+        """
+        routes = self.paths(source, [target])
+        if target not in routes:
+            raise nx.NetworkXNoPath('Node {} not reachable from {}'.format(
+                target, source))
+        return routes[target]
+
+    def paths(self, source, targets, cutoff=float('inf')):
+        """Return the shortest routes from source to each of targets.
+
+        Targets that are further than cutoff, or unreachable, are left out
+        of the returned dict.
+        """
+        s = self.ids[source]
+        forward, fparents, _ = self._search(s, self.up)
+        routes = {}
+        for target in targets:
+            t = self.ids[target]
+            if s == t:
+                routes[target] = []
+                continue
+            _, bparents, (dist, meet) = self._search(t, self.down, cutoff,
+                                                     forward)
+            if meet is None or dist > cutoff:
+                continue
+            arcs = []
+            node = meet
+            while fparents[node] is not None:
+                arcs.append((fparents[node], node))
+                node = fparents[node]
+            arcs.reverse()
+            node = meet
+            while bparents[node] is not None:
+                arcs.append((node, bparents[node]))
+                node = bparents[node]
+            path = []
+            for u, v in arcs:
+                path.extend(self._unpack(u, v))
+            routes[target] = path
+        return routes
+
+    def _unpack(self, u, v):
+        edges = []
+        stack = [(u, v)]
+        while stack:
+            a, b = stack.pop()
+            _, middle, key = self.arcs[a, b]
+            if middle < 0:
+                edges.append((self.nodes[a], self.nodes[b], key))
+            else:
+                stack.append((middle, b))
+                stack.append((a, middle))
+        return edges
+
+    def save(self, path):
+        """Write the hierarchy to a .npz file."""
+        arcs = sorted(self.arcs.items())
+        keys = [-1 if key is None else key for _, (_, __, key) in arcs]
+        np.savez_compressed(
+            path,
+            nodes=np.array(self.nodes, dtype=float),
+            integral=np.array([not isinstance(n, float) for n in self.nodes]),
+            node_ints=np.array([int(n) for n in self.nodes], dtype=np.int64),
+            rank=np.array(self.rank, dtype=np.int64),
+            src=np.array([u for (u, _), __ in arcs], dtype=np.int64),
+            dst=np.array([v for (_, v), __ in arcs], dtype=np.int64),
+            weight=np.array([w for _, (w, __, ___) in arcs], dtype=float),
+            middle=np.array([m for _, (__, m, ___) in arcs], dtype=np.int64),
+            key=np.array(keys, dtype=np.int64))
+
+    @classmethod
+    def load(cls, path):
+        """Read a hierarchy written by save."""
+        data = np.load(path)
+        ch = cls()
+        ch.nodes = [int(i) if integral else float(f) for f, i, integral in
+                    zip(data['nodes'], data['node_ints'], data['integral'])]
+        ch.ids = dict((n, i) for i, n in enumerate(ch.nodes))
+        ch.rank = data['rank'].tolist()
+        for u, v, w, m, key in zip(data['src'].tolist(), data['dst'].tolist(),
+                                   data['weight'].tolist(),
+                                   data['middle'].tolist(),
+                                   data['key'].tolist()):
+            ch.arcs[u, v] = (w, m, key if m < 0 else None)
+        ch._buildSearchGraphs()
+        return ch
@@ -0,0 +1,90 @@
+"""Module for measuring the stages of building and matching a topology."""
+
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# Fields that name a record rather than measure it, and fields that hold a
+# high-water mark, of which totals take the largest instead of the sum.
+_LABEL_FIELDS = ('stage', 'route')
+_PEAK_FIELDS = ('maxrss', 'peak')
+
+
+class PipelineStats(object):
+    """Collects wall time, memory use and element counts for each stage.
+
+    Pass one as `stats` to getNetworkTopology or the matching functions.
+    Every stage that runs adds a record, an OrderedDict with its 'stage'
+    name, its wall time in 'seconds', the peak resident set size of the
+    process so far in 'maxrss' (as reported by getrusage, where that is
+    available) and, if tracemalloc is tracing, the peak traced memory in
+    bytes during the stage in 'peak'. The remaining fields are the element
+    counts of the stage. `callback`, if given, is called with each record
+    as it is added.
+    """
+
+    def __init__(self, callback=None):
+        """Initialize with no records."""
+        self.callback = callback
+        self.records = []
+
+    def __len__(self):
+        """Number of records."""
+        return len(self.records)
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block as stage `name`.
+
+        Yields the record, so that counts can be set on it; it is added
+        once the block finishes without raising.
+        """
+        record = OrderedDict(stage=name)
+        tracing = tracemalloc is not None and tracemalloc.is_tracing()
+        if tracing and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        start = time.time()
+        yield record
+        record['seconds'] = time.time() - start
+        if resource is not None:
+            record['maxrss'] = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss
+        if tracing:
+            record['peak'] = tracemalloc.get_traced_memory()[1]
+        self.add(record)
+
+    def add(self, record):
+        """Add a record, such as one collected in another process."""
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def totals(self):
+        """Return the records summed per stage, in order of first record.
+
+        Each total counts its records in 'runs'. Peaks take the largest
+        value recorded.
+        """
+        totals = OrderedDict()
+        for record in self.records:
+            total = totals.setdefault(
+                record['stage'],
+                OrderedDict([('stage', record['stage']), ('runs', 0)]))
+            total['runs'] += 1
+            for name, value in record.items():
+                if name in _LABEL_FIELDS:
+                    continue
+                if name in _PEAK_FIELDS:
+                    total[name] = max(total.get(name, value), value)
+                else:
+                    total[name] = total.get(name, 0) + value
+        return totals
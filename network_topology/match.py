@@ -1,7 +1,8 @@
 """Module for map-matching source linestrings back to the topological graph."""
 
-import math
+import multiprocessing
 from itertools import count
+from collections import OrderedDict
 from heapq import heappush, heappop
 import networkx as nx
 from rtree import index
@@ -9,110 +10,361 @@ from shapely.geometry import Point
 import numpy as np
 import logging
 
+from .instrument import PipelineStats
+from .routing import RoutingGraph
+
 logger = logging.getLogger('network-topology')
-logger.setLevel(logging.INFO)
 
 
-def getMatchedRoutes(lineStrings, DG, increment=100., scope=30.):
-    """List the segments/edges that best match each linestring."""
-    idx = _buildIndex(DG)
-    paths = {}
-    for i, ls in lineStrings.items():
+def getMatchedRoutes(lineStrings, DG, increment=100., scope=30., workers=1,
+                     stats=None, maxCandidates=None, beamWidth=None):
+    """List the segments/edges that best match each linestring.
+
+    DG may be the graph from getNetworkTopology or a RoutingGraph built
+    from it. With `workers` other than 1, routes are matched in a pool of
+    that many processes (all cores if None). A PipelineStats given as
+    `stats` gets a 'match' record for each route, as from
+    TopologyMatcher.match_many. `maxCandidates` and `beamWidth` limit the
+    search as for TopologyMatcher.
+    """
+    matcher = TopologyMatcher(DG, increment=increment, scope=scope,
+                              maxCandidates=maxCandidates,
+                              beamWidth=beamWidth)
+    return matcher.match_many(lineStrings, workers=workers, stats=stats)
+
+
+class TopologyMatcher:
+    """Long-lived matcher holding a graph and its prebuilt edge index.
+
+    Keep one around to match routes as they arrive without rebuilding the
+    spatial index for every call.
+    """
+
+    def __init__(self, DG, increment=100., scope=30., hierarchy=None,
+                 cache=None, maxCandidates=None, beamWidth=None):
+        """Initialize and bulk-load the edge index for DG.
+
+        DG is converted to a RoutingGraph unless it already is one; all
+        routing runs on that, and matched edges are mapped back to the
+        (u, v, key) edges of DG. A ContractionHierarchy built for DG may be
+        given to answer route distance queries, and a PathCache to hold
+        the routes found.
+
+        By default every candidate is searched. Setting `maxCandidates`
+        keeps only that many of the nearest candidates per measurement, and
+        `beamWidth` carries only that many of the cheapest partial paths
+        from one measurement to the next (see _beam_search). Both trade
+        match quality for speed in dense areas.
+        """
+        if not isinstance(DG, RoutingGraph):
+            DG = RoutingGraph(DG)
+        if hierarchy is not None:
+            DG.hierarchy = hierarchy
+        self.graph = DG
+        self.cache = cache if cache is not None else PathCache()
+        self.increment = increment
+        self.scope = scope
+        self.maxCandidates = maxCandidates
+        self.beamWidth = beamWidth
+        self.index = _buildIndex(DG)
+
+    def __getstate__(self):
+        """Pickle without the index, which is rebuilt on unpickling."""
+        state = self.__dict__.copy()
+        del state['index']
+        return state
+
+    def __setstate__(self, state):
+        """Restore the matcher and rebuild its index."""
+        self.__dict__.update(state)
+        self.index = _buildIndex(self.graph)
+
+    def match(self, lineString, stats=None):
+        """List the edges that best match a single linestring.
+
+        A PipelineStats given as `stats` gets a 'match' record with the
+        number of candidates, the number of shortest_path and
+        shortest_paths searches run and the number of matched edges.
+        """
+        if stats is None:
+            stats = PipelineStats()
+        graph = self.graph
+        with stats.stage('match') as record:
+            searches = graph.pathSearches, graph.treeSearches
+            if self.maxCandidates or self.beamWidth:
+                layers = _findCandidateLayers(
+                    graph, self.index, lineString, increment=self.increment,
+                    scope=self.scope, maxCandidates=self.maxCandidates)
+                path = _beam_search(layers, Candidate(graph, start=True),
+                                    Candidate(graph, end=True), graph,
+                                    self.cache, self.increment,
+                                    self.beamWidth)
+                record['candidates'] = sum(len(layer) for layer in layers)
+            else:
+                adjacency_list, s, t = _findCandidatePoints(
+                    graph, self.index, lineString, increment=self.increment,
+                    scope=self.scope)
+                path = _viterbi_search(adjacency_list, s, t, graph,
+                                       self.cache, self.increment)
+                # Every candidate has an entry, as do the start and the end.
+                record['candidates'] = len(adjacency_list) - 2
+            record['pathSearches'] = graph.pathSearches - searches[0]
+            record['treeSearches'] = graph.treeSearches - searches[1]
+            record['edges'] = len(path)
+        return path
+
+    def match_many(self, lineStrings, workers=1, stats=None):
+        """List the matched edges for each linestring in a dict.
+
+        With `workers` other than 1, routes are matched in a pool of that
+        many processes (all cores if None). The matcher is sent to each
+        worker once, when it starts, so each has its own path cache; results
+        keep the input order and do not depend on the number of workers. A
+        PipelineStats given as `stats` gets the record of each route from
+        match, with its key in 'route', in input order.
+        """
+        items = list(lineStrings.items())
+        if workers == 1:
+            results = [self._matchItem(item) for item in items]
+        else:
+            workers = workers or multiprocessing.cpu_count()
+            chunksize = max(1, len(items) // (4 * workers))
+            pool = multiprocessing.Pool(workers, _initWorker, (self,))
+            try:
+                results = pool.map(_matchWorker, items, chunksize)
+            finally:
+                pool.close()
+                pool.join()
+        paths = {}
+        for (i, _), (path, records) in zip(items, results):
+            paths[i] = path
+            if stats is not None:
+                for record in records:
+                    stats.add(record)
+        return paths
+
+    def _matchItem(self, item):
+        i, ls = item
         logger.info('Matching shape {}'.format(i))
-        adjacency_list, s, t = _findCandidatePoints(DG, idx, ls,
-                                                    increment=increment,
-                                                    scope=scope)
-        path = _viterbi_search(adjacency_list, s, t, DG, increment)
-        paths[i] = path
-    return paths
+        stats = PipelineStats()
+        path = self.match(ls, stats)
+        for record in stats.records:
+            record['route'] = i
+        return path, stats.records
 
 
-def _buildIndex(DG):
-    shapeIdx = index.Index()
-    for u, v, i, data in DG.edges(data=True, keys=True):
-        shapeIdx.insert(hash((u, v, i)), data['geom'].bounds, obj=(u, v, i))
-    return shapeIdx
+# Per-process matcher for pooled matching, set up once by _initWorker.
+_worker = {}
 
 
-def _getDirection(line, distance):
-    if distance == line.length:
-        n1 = 1. - 1e-9
-        n2 = 1.
-    else:
-        n1 = distance / line.length
-        n2 = n1 + 1e-9
-    p1 = line.interpolate(n1, normalized=True)
-    p2 = line.interpolate(n2, normalized=True)
-    return (p2.x - p1.x, p2.y - p1.y)
-
-
-def _findCandidatePoints(DG, shapeIdx, lineString, increment=100., scope=30.):
-    adjacency_list = {}
-    totalLength = lineString.length
-    s = Candidate(DG, start=True)
-    t = Candidate(DG, end=True)
-    lastRound = [s]
-    adjacency_list[t] = []
+def _initWorker(matcher):
+    _worker['matcher'] = matcher
 
-    simpleLine = lineString.simplify(scope/2.)
-    cornerPts = [Point(c) for c in simpleLine.coords[1:-1]]
-
-    points = [(Point(lineString.coords[0]), _getDirection(lineString, 0))]
-    searchRange = [increment, min(increment*2.0, totalLength - increment)]
-    failureCount = 0
-    while searchRange[1] > searchRange[0]:
-        d = np.random.uniform(*searchRange)
-        p = lineString.interpolate(d)
-        collision = False
-        for corner in cornerPts:
-            if abs(p.x - corner.x) < scope and abs(p.y - corner.y) < scope:
-                if p.distance(corner) < scope:
-                    failureCount += 1
-                    collision = True
-                    break
-        if failureCount >= 20:
-            searchRange = [searchRange[1],
-                           min(searchRange[1]+scope, totalLength-increment)]
-            failureCount = 0
-        if not collision:
-            points.append((p, _getDirection(lineString, d)))
-            searchRange = [d + increment,
-                           min(d + 2. * increment, totalLength-increment)]
-    points.append((Point(lineString.coords[-1]),
-                   _getDirection(lineString, totalLength)))
-
-    firstLast = points[::len(points)-1]
-    for p, pdir in points:
-        nextRound = []
-        for item in shapeIdx.intersection((p.x-scope, p.y-scope,
-                                           p.x+scope, p.y+scope),
-                                          objects=True):
-            u, v, i = item.object
-            if DG[u][v][i]['terminal'] and p not in firstLast:
-                continue
-            candidate = Candidate(DG, segment=item.object, measurement=p)
-            if candidate.distance < scope:
-                sdir = _getDirection(DG[u][v][i]['geom'], candidate.offset)
-                if np.dot(pdir, sdir) >= 0:
-                    nextRound.append(candidate)
-        if nextRound:
-            for prev in lastRound:
-                adjacency_list[prev] = list(nextRound)
-            lastRound = nextRound
-            #pprint(nextRound)
+
+def _matchWorker(item):
+    return _worker['matcher']._matchItem(item)
+
+
+def _buildIndex(graph):
+    minx, miny, maxx, maxy = graph.bounds()
+    return index.Index((e, (minx[e], miny[e], maxx[e], maxy[e]), None)
+                       for e in range(len(minx)))
+
+
+def _findCandidatePoints(graph, shapeIdx, lineString, increment=100.,
+                         scope=30.):
+    """Return the candidate graph for the measurements along a line.
+
+    Every candidate of a layer from _findCandidateLayers is linked to
+    every candidate of the next, from the start candidate `s` to the end
+    candidate `t`.
+    """
+    s = Candidate(graph, start=True)
+    t = Candidate(graph, end=True)
+    adjacency_list = {t: []}
+    lastRound = [s]
+    for nextRound in _findCandidateLayers(graph, shapeIdx, lineString,
+                                          increment, scope):
+        for prev in lastRound:
+            adjacency_list[prev] = list(nextRound)
+        lastRound = nextRound
     for prev in lastRound:
         adjacency_list[prev] = [t]
     return adjacency_list, s, t
 
 
-def _viterbi_search(adjacency_list, s, t, DG, increment):
+def _findCandidateLayers(graph, shapeIdx, lineString, increment=100.,
+                         scope=30., maxCandidates=None):
+    """Return the candidates for each measurement along a line.
+
+    Measurements are taken at the ends of the line and at the positions
+    from _samplePositions, away from its corners, so the same line always
+    gives the same candidates. Measurements without candidates are left
+    out. With `maxCandidates`, only that many candidates with the lowest
+    emission cost are kept for each measurement.
+    """
+    coords = np.asarray(lineString.coords, dtype=float)[:, :2]
+    x0, y0 = coords[:-1, 0], coords[:-1, 1]
+    dx, dy = np.diff(coords[:, 0]), np.diff(coords[:, 1])
+    lengths = np.hypot(dx, dy)
+    # Zero-length segments have no direction and cover no distance.
+    keep = lengths > 0
+    x0, y0, dx, dy, lengths = x0[keep], y0[keep], dx[keep], dy[keep], \
+        lengths[keep]
+    along = np.cumsum(lengths) - lengths
+    totalLength = float(lengths.sum())
+
+    simpleLine = lineString.simplify(scope/2.)
+    corners = np.asarray(simpleLine.coords, dtype=float)[1:-1, :2]
+    starts, ends = _allowedIntervals(x0, y0, dx, dy, lengths, along,
+                                     totalLength, corners, scope)
+    d = np.array([0.] + _samplePositions(starts, ends, totalLength,
+                                         increment, scope) + [totalLength])
+    if len(lengths):
+        # Each point takes the direction of the segment that it starts, or
+        # of the last segment at the end of the line.
+        seg = np.clip(np.searchsorted(along, d, side='right') - 1, 0,
+                      len(lengths) - 1)
+        frac = (d - along[seg]) / lengths[seg]
+        px, py = x0[seg] + frac * dx[seg], y0[seg] + frac * dy[seg]
+        pdirs = np.column_stack([dx[seg], dy[seg]])
+        px[0], py[0] = coords[0]
+        px[-1], py[-1] = coords[-1]
+    else:
+        px, py = coords[[0, -1], 0], coords[[0, -1], 1]
+        pdirs = np.zeros((2, 2))
+    # Terminal edges only match the first and last points.
+    terminal = np.zeros(len(px), dtype=bool)
+    terminal[[0, -1]] = True
+    return [r for r in _findCandidates(graph, shapeIdx, px, py, pdirs,
+                                       terminal, scope, maxCandidates) if r]
+
+
+def _findCandidates(graph, shapeIdx, px, py, pdirs, terminal, scope=30.,
+                    maxCandidates=None):
+    """Return the candidates for each measurement, nearest first.
+
+    Candidates are edges within scope of a measurement that do not run
+    against its direction in `pdirs`; a zero direction allows either.
+    Terminal edges are only candidates where `terminal` is set. With
+    `maxCandidates`, only that many are kept for each measurement.
+    """
+    points = [Point(x, y) for x, y in zip(px.tolist(), py.tolist())]
+    hits = [list(shapeIdx.intersection((p.x-scope, p.y-scope,
+                                        p.x+scope, p.y+scope)))
+            for p in points]
+    pid = np.repeat(np.arange(len(points)), [len(h) for h in hits])
+    eid = np.array([e for h in hits for e in h], dtype=int)
+    keep = ~graph.terminal[eid] | terminal[pid]
+    pid, eid = pid[keep], eid[keep]
+    offset, distance, sdx, sdy = graph.project(eid, px[pid], py[pid])
+    keep = ((distance < scope) &
+            (pdirs[pid, 0] * sdx + pdirs[pid, 1] * sdy >= 0))
+    rounds = [[] for _ in points]
+    for j in np.flatnonzero(keep):
+        rounds[pid[j]].append(Candidate(graph, segment=int(eid[j]),
+                                           measurement=points[pid[j]],
+                                           offset=offset[j],
+                                           distance=distance[j]))
+    if maxCandidates:
+        rounds = [sorted(r, key=lambda c: c.distance)[:maxCandidates]
+                  for r in rounds]
+    return rounds
+
+
+def _allowedIntervals(x0, y0, dx, dy, lengths, along, totalLength, corners,
+                      scope):
+    """Return the stretches of a line that are at least scope from corners.
+
+    The line is given by its segments, starting at (x0, y0) and running
+    (dx, dy), `along` the line from its start. Returns sorted, disjoint
+    (starts, ends) arrays of distances along the line.
+    """
+    # Only pair segments with the corners that fall within scope of their
+    # x range, found from the corners sorted by x.
+    order = np.argsort(corners[:, 0], kind='mergesort')
+    cx = corners[order, 0]
+    lo = np.searchsorted(cx, np.minimum(x0, x0 + dx) - scope)
+    hi = np.searchsorted(cx, np.maximum(x0, x0 + dx) + scope, side='right')
+    counts = np.maximum(hi - lo, 0)
+    seg = np.repeat(np.arange(len(x0)), counts)
+    groups = np.cumsum(counts) - counts
+    corner = order[np.arange(counts.sum()) - np.repeat(groups, counts) +
+                   np.repeat(lo, counts)]
+
+    # Solve |p + t d - c| < scope for the fraction t along each segment.
+    ox = x0[seg] - corners[corner, 0]
+    oy = y0[seg] - corners[corner, 1]
+    a = lengths[seg] ** 2
+    b = ox * dx[seg] + oy * dy[seg]
+    disc = b * b - a * (ox * ox + oy * oy - scope * scope)
+    near = disc > 0
+    root = np.sqrt(disc[near])
+    t0 = np.clip((-b[near] - root) / a[near], 0., 1.)
+    t1 = np.clip((-b[near] + root) / a[near], 0., 1.)
+    seg = seg[near]
+    excludedStarts = along[seg] + t0 * lengths[seg]
+    excludedEnds = along[seg] + t1 * lengths[seg]
+
+    # Merge the excluded stretches, including ones that only touch where
+    # segments meet, and return the gaps between them.
+    order = np.argsort(excludedStarts, kind='mergesort')
+    excludedStarts, excludedEnds = excludedStarts[order], excludedEnds[order]
+    reach = np.maximum.accumulate(excludedEnds) if len(order) else \
+        excludedEnds
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = excludedStarts[1:] > reach[:-1] + _TOUCHING
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = first[1:]
+    starts = np.concatenate([[0.], reach[last]])
+    ends = np.concatenate([excludedStarts[first], [totalLength]])
+    keep = ends > starts + _TOUCHING
+    return starts[keep], ends[keep]
+
+
+def _samplePositions(starts, ends, totalLength, increment, scope):
+    """Return the distances along a line at which to take measurements.
+
+    Each sample is taken between increment and twice increment past the
+    last, as near to the middle of that window as the allowed stretches
+    permit, and no closer than increment to the end of the line. If no
+    allowed position is left in the window, the first one past it is used.
+    """
+    limit = totalLength - increment
+    positions = []
+    last = 0.
+    while True:
+        lo = last + increment
+        hi = min(last + 2. * increment, limit)
+        if hi <= lo:
+            break
+        target = (lo + hi) / 2.
+        i = int(np.searchsorted(ends, target))
+        if i < len(starts) and starts[i] <= target:
+            d = target
+        else:
+            options = []
+            if i > 0 and ends[i - 1] >= lo:
+                options.append(ends[i - 1])
+            if i < len(starts) and starts[i] <= hi:
+                options.append(starts[i])
+            if options:
+                d = min(options, key=lambda o: abs(o - target))
+            elif i < len(starts) and starts[i] < limit:
+                d = starts[i]
+            else:
+                break
+        positions.append(float(d))
+        last = d
+    return positions
+
+
+def _viterbi_search(adjacency_list, s, t, graph, cache, increment):
     # With credit to the "Map Matching in a Programmer's Perspective" guide
     # in Valhalla by Mapzen:
     # https://github.com/valhalla/meili/blob/master/docs/meili/algorithms.md
 
     # Initialize joint probability for each node
-    if 'path_cache' not in DG.graph:
-        DG.graph['path_cache'] = SequenceCache()
     cost = {}
     for u in adjacency_list:
         cost[u] = 1e100
@@ -127,183 +379,169 @@ def _viterbi_search(adjacency_list, s, t, DG, increment):
         u = queue.pop()
         if u == t:
             break
+        u._route_distances_to(adjacency_list[u], cache, increment)
         for v in adjacency_list[u]:
             # Relaxation
             new_cost = (cost[u] +
-                        u.transition_cost(v, DG.graph['path_cache']) +
+                        u.transition_cost(v, cache) +
                         v.emission_cost())
             if cost[v] > new_cost:
                 cost[v] = new_cost
                 predecessor[v] = u
             queue.add_or_update(v, cost[v])
-    return _construct_path(predecessor, s, t, DG, increment)
+    return _construct_path(predecessor, s, t, graph, cache, increment)
+
 
+def _beam_search(layers, s, t, graph, cache, increment, beamWidth=None):
+    """Viterbi search over the candidate layers, one layer at a time.
 
-def _construct_path(predecessor, s, t, DG, increment):
-    cache = DG.graph['path_cache']
+    Unlike _viterbi_search, the search runs through a trellis of the
+    layers from `s` to `t`. With `beamWidth`, only that many of the
+    cheapest paths are carried from each layer to the next.
+    """
+    predecessor = {s: None}
+    paths = [(s.emission_cost(), s)]
+    for layer in layers + [[t]]:
+        paths = _extendPaths(paths, layer, predecessor, cache, increment,
+                             beamWidth)
+    return _construct_path(predecessor, s, t, graph, cache, increment)
+
+
+def _extendPaths(paths, layer, predecessor, cache, increment, beamWidth=None):
+    """Extend paths by one layer of candidates.
+
+    `paths` lists (cost, candidate) pairs for the ends of the paths so
+    far, cheapest first. Returns the cheapest path to each candidate of
+    `layer` in the same form, keeping at most `beamWidth` of them, and
+    records the predecessor of each. Costs only grow along a path, so
+    once the beam is full, the remaining, costlier paths are not
+    extended at all if they already cost more than the last path in it.
+    """
+    best = {}
+    bound = float('inf')
+    for cost, u in paths:
+        if cost >= bound:
+            break
+        u._route_distances_to(layer, cache, increment)
+        for v in layer:
+            new_cost = (cost + u.transition_cost(v, cache) +
+                        v.emission_cost())
+            if new_cost < best.get(v, float('inf')):
+                best[v] = new_cost
+                predecessor[v] = u
+        if beamWidth and len(best) >= beamWidth:
+            bound = sorted(best.values())[beamWidth - 1]
+    extended = sorted([(best[v], v) for v in layer if v in best],
+                      key=lambda path: path[0])
+    return extended[:beamWidth] if beamWidth else extended
+
+
+def _construct_path(predecessor, s, t, graph, cache, increment):
     cur = predecessor[t]
+    if cur is s:
+        # No measurement had any candidates.
+        return []
     sequence = [cur.segment]
     prev = predecessor[cur]
     while prev is not s:
-        if not(prev.segment == cur.segment and prev.offset <= cur.offset):
-            if (prev.segment[1], cur.segment[0]) in cache:
-                cVal = cache[prev.segment[1], cur.segment[0]][1]
-                sequence = cVal + sequence
-        if (len(sequence) == 0 or sequence[0] != prev.segment):
-            sequence.insert(0, prev.segment)
+        sequence = _joinSegments(prev, cur, graph, cache) + sequence
         cur = prev
         prev = predecessor[cur]
-    sequence = [(u, v, i) for u, v, i in sequence if not DG[u][v][i]['terminal']]
+    sequence = _dropReversals(
+        [e for e in sequence if not graph.terminal[e]], graph, increment)
+    return [graph.edge(e) for e in sequence]
+
+
+def _joinSegments(prev, cur, graph, cache):
+    """Return the edge ids from the segment of prev up to that of cur.
 
+    The segment of cur itself is not included. Where no route joins
+    them, the path just breaks after the segment of prev.
+    """
+    sequence = []
+    if not(prev.segment == cur.segment and prev.offset <= cur.offset):
+        route = prev._route_to(cur, cache)
+        if route is not None:
+            sequence = list(route[1])
+    if (sequence or [cur.segment])[0] != prev.segment:
+        sequence.insert(0, prev.segment)
+    return sequence
+
+
+def _dropReversals(sequence, graph, increment):
+    """Drop short edges that are followed straight away by their twin."""
     duplicates = []
     lastIndex = -10
-    for i, (s1, s2) in enumerate(zip(sequence[:-1], sequence[1:])):
+    for i, (e1, e2) in enumerate(zip(sequence[:-1], sequence[1:])):
         if i == lastIndex:
             continue
-        if s1[0] == s2[1] and s1[2] == s2[2]:
-            if DG[s1[0]][s1[1]][s1[2]]['geom'].length < increment*4.:
+        if graph.src[e1] == graph.dst[e2] and graph.key[e1] == graph.key[e2]:
+            if graph.length[e1] < increment*4.:
                 duplicates.append(i)
                 duplicates.append(i+1)
                 lastIndex = i + 1
+    return [e for i, e in enumerate(sequence) if i not in duplicates]
+
+
+def _cachedRoute(graph, cache, source, target):
+    """Return the cached (length, edge ids) route, or None if not cached.
 
-    return [p for i, p in enumerate(sequence) if i not in duplicates]
-
-
-def _distanceBetweenNodes(G, a, b):
-    x1 = G.node[a]['x']
-    y1 = G.node[a]['y']
-    x2 = G.node[b]['x']
-    y2 = G.node[b]['y']
-    return math.sqrt((x1-x2)**2. + (y1-y2)**2.)
-
-
-def _astar_path(G, source, target, weight='length'):
-    """Return a list of edges in a shortest path between source and target
-    using the A* ("A-star") algorithm.
-    There may be more than one shortest path.  This returns only one.
-    This code is adapted for multigraph from the networkx library
-    Parameters
-    ----------
-    G : NetworkX graph
-    source : node
-       Starting node for path
-    target : node
-       Ending node for path
-    heuristic : function
-       A function to evaluate the estimate of the distance
-       from the a node to the target.  The function takes
-       two nodes arguments and must return a number.
-    weight: string, optional (default='weight')
-       Edge data key corresponding to the edge weight.
-    Raises
-    ------
-    NetworkXNoPath
-        If no path exists between source and target.
-    Examples
-    --------
-    >>> G = nx.path_graph(5)
-    >>> print(nx.astar_path(G, 0, 4))
-    [0, 1, 2, 3, 4]
-    >>> G = nx.grid_graph(dim=[3, 3])  # nodes are two-tuples (x,y)
-    >>> nx.set_edge_attributes(G, {e: e[1][0]*2 for e in G.edges()}, 'cost')
-    >>> def dist(a, b):
-    ...    (x1, y1) = a
-    ...    (x2, y2) = b
-    ...    return ((x1 - x2) ** 2 + (y1 - y2) ** 2) ** 0.5
-    >>> print(nx.astar_path(G, (0, 0), (2, 2), heuristic=dist, weight='cost'))
-    [(0, 0), (0, 1), (0, 2), (1, 2), (2, 2)]
-    See Also
-    --------
-    shortest_path, dijkstra_path
+    A route cached the other way round is used reversed, as long as all of
+    its edges have twins. An entry with no edges, which marks nodes with
+    no route between them, is never reversed.
     """
-    if source not in G or target not in G:
-        msg = 'Either source {} or target {} is not in G'
-        raise nx.NodeNotFound(msg.format(source, target))
-
-    # if heuristic is None:
-    #     # The default heuristic is h=0 - same as Dijkstra's algorithm
-    #     def heuristic(u, v):
-    #         return 0
-
-    push = heappush
-    pop = heappop
-
-    # The queue stores priority, node, cost to reach, and parent.
-    # Uses Python heapq to keep in priority order.
-    # Add a counter to the queue to prevent the underlying heap from
-    # attempting to compare the nodes themselves. The hash breaks ties in the
-    # priority and is guarenteed unique for all nodes in the graph.
-    c = count()
-    queue = [(0, next(c), source, 0, None, None)]
-
-    # Maps enqueued nodes to distance of discovered paths and the
-    # computed heuristics to target. We avoid computing the heuristics
-    # more than once and inserting the node into the queue too many times.
-    enqueued = {}
-    # Maps explored nodes to parent closest to the source.
-    explored = {}
-
-    while queue:
-        # Pop the smallest item from queue.
-        _, __, curnode, dist, parent, via = pop(queue)
-
-        if curnode == target:
-            path = []
-            node = curnode
-            edge = via
-            while parent is not None:
-                path.append((parent, node, edge))
-                node = parent
-                parent, edge = explored[node]
-            path.reverse()
-            return path
-
-        if curnode in explored:
-            continue
+    if (source, target) in cache:
+        return cache[source, target]
+    if (target, source) in cache:
+        length, sequence = cache[target, source]
+        reverse = graph.reverse_path(sequence) if sequence else None
+        if reverse is not None:
+            return length, reverse
+    return None
 
-        explored[curnode] = parent, via
-
-        for neighbor, es in G[curnode].items():
-            for edge, w in es.items():
-                if neighbor in explored:
-                    continue
-                ncost = dist + w.get(weight, 1)
-                if neighbor in enqueued:
-                    qcost, h = enqueued[neighbor]
-                    # if qcost < ncost, a longer path to neighbor remains
-                    # enqueued. Removing it would need to filter the whole
-                    # queue, it's better just to leave it there and ignore
-                    # it when we visit the node a second time.
-                    if qcost <= ncost:
-                        continue
-                else:
-                    h = _distanceBetweenNodes(G, neighbor, target)
-                enqueued[neighbor] = ncost, h
-                push(queue, (ncost + h, next(c), neighbor, ncost, curnode, edge))
-
-    raise nx.NetworkXNoPath("Node %s not reachable from %s" % (source, target))
 
 SIGMA_Z = 4.07
 BETA = 3
+# Multiple of the sample spacing beyond which routes are not searched.
+SEARCH_RADIUS_FACTOR = 3.
+# Distance along a line within which stretches count as touching.
+_TOUCHING = 1e-6
+# Cost of a transition with no route, so that a route with a gap that
+# cannot be bridged still matches, with a break there.
+UNREACHABLE_COST = 1e9
 INVERSE_2_SIGMA_SQUARED = 1. / (SIGMA_Z ** 2. * 2.)
 INVERSE_BETA = 1. / BETA
 
 class Candidate:
     """Class for candidate segment."""
 
-    def __init__(self, DG, segment=None, measurement=None,
-                 start=False, end=False):
-        """Initialize."""
+    def __init__(self, graph, segment=None, measurement=None,
+                 start=False, end=False, offset=None, distance=None):
+        """Initialize.
+
+        `segment` is an edge id of the RoutingGraph. The offset and distance
+        of the measurement along and from the segment are computed unless
+        they are given.
+        """
         self.start = start
         self.end = end
         self.measurement = measurement
         self.segment = segment
-        self.DG = DG
-        if segment:
-            geom = DG.get_edge_data(*segment)['geom']
-            self.offset = geom.project(measurement)
-            self.distance = geom.distance(measurement)
-            self.remaining = geom.length - self.offset
+        self.graph = graph
+        # Length beyond which routes from here count as unreachable, set up
+        # by _route_distances_to and measured by _cutoff when needed. It is
+        # never below _minCutoff.
+        self.cutoff = self._minCutoff = float('inf')
+        self._searched = None
+        if segment is not None:
+            if offset is None:
+                offset, distance, _, __ = graph.project(
+                    np.array([segment]), np.array([measurement.x]),
+                    np.array([measurement.y]))
+                offset, distance = offset[0], distance[0]
+            self.offset = float(offset)
+            self.distance = float(distance)
+            self.remaining = float(graph.length[segment]) - self.offset
             self.hash = hash((self.segment, self.offset))
         else:
             self.distance = 0
@@ -351,7 +589,7 @@ class Candidate:
 
         #prob = c * math.exp(-delta*c)
         #return -1 * math.log10(max(prob, sys.float_info.min))
-        return delta * INVERSE_BETA
+        return min(delta * INVERSE_BETA, UNREACHABLE_COST)
 
     def _route_distance_to(self, nextCandidate, cache):
         if nextCandidate.segment == self.segment and nextCandidate.offset >= self.offset:
@@ -359,30 +597,92 @@ class Candidate:
         if self.segment is None or nextCandidate.segment is None:
             return 0, 0
         terminalDistance = self.remaining + nextCandidate.offset
-        if self.segment[1] == nextCandidate.segment[0]:
-            return terminalDistance, 1
-        sumDistance = 0
-        index = (self.segment[1], nextCandidate.segment[0])
-        if index in cache:
-            sumDistance, edgeSequence = cache[index]
-        else:
-            edgeSequence = []
-            distances = []
+        route = self._route_to(nextCandidate, cache)
+        if route is None:
+            return float('inf'), 1
+        sumDistance, edgeSequence = route
+        return sumDistance + terminalDistance, len(edgeSequence) + 1
+
+    def _route_to(self, nextCandidate, cache):
+        """Return (length, edge ids) from this segment to the next one's.
+
+        Returns None if there is no route, or none within the cutoff. A
+        route that is not cached is searched for and cached.
+        """
+        source = int(self.graph.dst[self.segment])
+        target = int(self.graph.src[nextCandidate.segment])
+        if source == target:
+            return 0., []
+        route = _cachedRoute(self.graph, cache, source, target)
+        if route is None:
+            if cache.unreachable(source, target, self._cutoff()):
+                return None
             try:
-                sequence = _astar_path(self.DG, self.segment[1],
-                                            nextCandidate.segment[0],
-                                            weight='length')
-                #for u, v in zip(sequence[:-1], sequence[1:]):
-                #    i = min(self.DG[u][v],
-                #            key=lambda x: self.DG[u][v][x]['length'])
-                for u, v, i in sequence:
-                    edgeSequence.append((u, v, i))
-                    distances.append(self.DG[u][v][i]['length'])
+                sequence = self.graph.shortest_path(source, target)
             except nx.NetworkXException:
-                distances = [float('inf')]
-            #cache[index] = sumDistance, edgeSequence
-            cache.add(distances, edgeSequence)
-        return sumDistance + terminalDistance, len(edgeSequence) + 1
+                cache.add_unreachable(source, target, float('inf'))
+                return None
+            distances = self.graph.length[sequence].tolist()
+            cache.add([source] + self.graph.dst[sequence].tolist(),
+                      distances, sequence)
+            route = sum(distances), sequence
+        if route[0] > self._minCutoff and route[0] > self._cutoff():
+            return None
+        return route
+
+    def _route_distances_to(self, candidates, cache, increment):
+        """Cache routes to all of the candidates with a single search.
+
+        The search stops at the cutoff, which is kept for the transitions
+        to the candidates: routes longer than that count as unreachable,
+        since their transition cost would rule them out anyway, whether
+        or not a longer route is cached. Targets not reached are cached
+        as unreachable within the cutoff only, so that a later search with
+        a larger cutoff still looks for them.
+        """
+        if self.segment is None:
+            return
+        self._searched = candidates
+        self._minCutoff = SEARCH_RADIUS_FACTOR * increment
+        self.cutoff = None
+        source = int(self.graph.dst[self.segment])
+        targets = set(int(self.graph.src[c.segment]) for c in candidates
+                      if c.segment is not None)
+        targets = [n for n in targets if n != source and
+                   _cachedRoute(self.graph, cache, source, n) is None]
+        if not targets:
+            return
+        cutoff = self._cutoff()
+        targets = [n for n in targets
+                   if not cache.unreachable(source, n, cutoff)]
+        if not targets:
+            return
+        routes = self.graph.shortest_paths(source, targets, cutoff)
+        for target in targets:
+            if target in routes:
+                sequence = routes[target]
+                cache.add([source] + self.graph.dst[sequence].tolist(),
+                          self.graph.length[sequence].tolist(), sequence)
+            else:
+                cache.add_unreachable(source, target, cutoff)
+
+    def _cutoff(self):
+        """Return the cutoff of the last search from here.
+
+        It is SEARCH_RADIUS_FACTOR times the sample spacing plus the gap to
+        the measurement searched for. The gap is only measured the first
+        time the cutoff is needed, since most routes are shorter than the
+        least it can be.
+        """
+        if self.cutoff is None:
+            # The candidates of a layer share their measurement.
+            measurements = dict((id(c.measurement), c.measurement)
+                                for c in self._searched
+                                if c.measurement is not None)
+            gap = max([self.measurement.distance(m)
+                       for m in measurements.values()] + [0])
+            self.cutoff = self._minCutoff + SEARCH_RADIUS_FACTOR * gap
+        return self.cutoff
 
 
 class PriorityQueue:
@@ -433,46 +733,157 @@ class PriorityQueue:
         return len(self.pq) == 0
 
 
-class SequenceCache(dict):
-    def __init__(self, *args, **kwargs):
-        self.update(*args, **kwargs)
+class _StoredPath(object):
+    """One cached edge sequence, with the position of each node along it."""
 
-    def __contains__(self, key):
-        s, t = key
-        return dict.__contains__(self, (s, t)) or dict.__contains__(self, (t, s))
+    __slots__ = ('serial', 'edges', 'cum', 'pos')
 
-    def __getitem__(self, key):
-        s, t = key
-        if dict.__contains__(self, (s, t)):
-            return dict.__getitem__(self, key)
-        elif dict.__contains__(self, (t, s)):
-            length, sequence = dict.__getitem__(self, (t, s))
-            sequence = [(v, u, i) for u, v, i in reversed(sequence)]
-            return length, sequence
-        else:
-            raise KeyError(key)
+    def __init__(self, serial, nodes, edges, cum):
+        """Initialize with the nodes, edges and cumulative lengths."""
+        self.serial = serial
+        self.edges = edges
+        self.cum = cum
+        self.pos = dict((n, i) for i, n in enumerate(nodes))
 
-    def add(self, lengths, sequence):
-        if sequence:
-            s, t = sequence[0][0], sequence[-1][1]
-            dict.__setitem__(self, (s, t), (sum(lengths), sequence))
-            if len(sequence) > 1:
-                s, t = sequence[0][0], sequence[-2][1]
-                if (s, t) not in self:
-                    self.add(lengths[:-1], sequence[:-1])
-                s, t = sequence[1][0], sequence[-1][1]
-                if (s, t) not in self:
-                    self.add(lengths[1:], sequence[1:])
-
-    # def __setitem__(self, key, sequence):
-    #     dict.__setitem__(self, key, sequence)
-    #     if len(sequence) > 1:
-    #         if
+    def span(self, i, j):
+        """Return (length, edges) from the ith node to the jth."""
+        if len(self.cum) != len(self.edges) + 1:
+            # Stored for its end nodes only, by PathCache.__setitem__.
+            return self.cum[j] - self.cum[i], self.edges
+        return self.cum[j] - self.cum[i], self.edges[i:j]
 
-    def __repr__(self):
-        dictrepr = dict.__repr__(self)
-        return '{}({})'.format(type(self).__name__, dictrepr)
 
-    def update(self, *args, **kwargs):
-        for k, v in dict(*args, **kwargs).iteritems():
-            self[k] = v
+class PathCache:
+    """Bounded LRU cache of shortest edge sequences between nodes.
+
+    Each path is stored once, with its cumulative lengths and the position
+    of each of its nodes, so that every subpath of it is found by looking
+    up its start and end nodes; paths are indexed by node for that. Least
+    recently used paths are evicted once there are more than `maxsize` of
+    them, or once they hold more than `maxEdges` edges. Lookups are
+    directed: (s, t) does not answer for (t, s). Hits and misses are
+    counted by membership tests.
+
+    Node pairs with no route within a search cutoff are kept apart from
+    the paths, with the largest cutoff searched, so that they only answer
+    for searches that go no further. Up to `maxsize` of them are kept.
+    """
+
+    def __init__(self, maxsize=10000, maxEdges=None):
+        """Initialize an empty cache."""
+        self.maxsize = maxsize
+        self.maxEdges = maxEdges
+        self.paths = OrderedDict()
+        self.byNode = {}
+        self.missing = OrderedDict()
+        self.storedEdges = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._serial = count()
+        # The last lookup, since a membership test is usually followed by
+        # getting the same path.
+        self._last = None, None
+
+    def __len__(self):
+        """Number of cached paths."""
+        return len(self.paths)
+
+    def __contains__(self, key):
+        """Whether a path from the first node to the second is cached."""
+        if self._find(key) is not None:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def __getitem__(self, key):
+        """Return (length, edge sequence) for the path from s to t."""
+        found = self._find(key)
+        if found is None:
+            raise KeyError(key)
+        record, i, j = found
+        # Mark the path as recently used.
+        self.paths[record.serial] = self.paths.pop(record.serial)
+        length, sequence = record.span(i, j)
+        return length, list(sequence)
+
+    def __setitem__(self, key, value):
+        """Cache a (length, edge sequence) pair for just its end nodes."""
+        length, sequence = value
+        # An empty sequence marks nodes with no route between them.
+        self._insert(key, tuple(sequence), [0., length])
+
+    def add(self, nodes, lengths, sequence):
+        """Cache a path, which also answers for all of its subpaths.
+
+        `nodes` lists the nodes along the path, one more than its edges.
+        """
+        if not sequence:
+            return
+        cum = [0.]
+        for length in lengths:
+            cum.append(cum[-1] + length)
+        self._insert(nodes, tuple(sequence), cum)
+
+    def add_unreachable(self, source, target, cutoff):
+        """Record that no route from source to target is within cutoff."""
+        key = source, target
+        cutoff = max(cutoff, self.missing.pop(key, cutoff))
+        self.missing[key] = cutoff
+        while len(self.missing) > self.maxsize:
+            self.missing.popitem(last=False)
+
+    def unreachable(self, source, target, cutoff):
+        """Whether no route from source to target is within cutoff."""
+        return self.missing.get((source, target), -1.) >= cutoff
+
+    def stats(self):
+        """Return the cache counters as a dict."""
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'paths': len(self.paths),
+                'edges': self.storedEdges,
+                'unreachable': len(self.missing)}
+
+    def _find(self, key):
+        if self._last[0] == key:
+            return self._last[1]
+        found = self._search(key)
+        self._last = key, found
+        return found
+
+    def _search(self, key):
+        s, t = key
+        starts = self.byNode.get(s)
+        ends = self.byNode.get(t)
+        if not starts or not ends:
+            return None
+        # Check the paths through whichever node has fewer of them.
+        for record in (starts if len(starts) <= len(ends) else ends).values():
+            i = record.pos.get(s)
+            j = record.pos.get(t)
+            if i is not None and j is not None and i < j:
+                return record, i, j
+        return None
+
+    def _insert(self, nodes, edges, cum):
+        self._last = None, None
+        record = _StoredPath(next(self._serial), nodes, edges, cum)
+        self.paths[record.serial] = record
+        for n in record.pos:
+            self.byNode.setdefault(n, {})[record.serial] = record
+        self.storedEdges += len(edges)
+        while self.paths and (
+                len(self.paths) > self.maxsize or
+                (self.maxEdges is not None and
+                 self.storedEdges > self.maxEdges)):
+            _, record = self.paths.popitem(last=False)
+            for n in record.pos:
+                paths = self.byNode[n]
+                del paths[record.serial]
+                if not paths:
+                    del self.byNode[n]
+            self.storedEdges -= len(record.edges)
+            self.evictions += 1
@@ -0,0 +1,164 @@
+"""Module for map-matching positions as they arrive, one vehicle at a time."""
+
+import math
+from collections import deque
+import numpy as np
+
+from .match import (Candidate, _findCandidates, _extendPaths, _joinSegments,
+                    _dropReversals)
+
+
+class OnlineMatcher(object):
+    """Matches a stream of positions, emitting edges once they are settled.
+
+    Positions are sampled as getMatchedRoutes samples a line: one is
+    taken as a measurement whenever it is at least `increment` from the
+    last, and its candidates are found within `scope`. Paths through the
+    candidates are extended one measurement at a time. An edge is settled
+    once all surviving paths run through it, since later positions can no
+    longer change it. At most `window` measurements are left unsettled:
+    when the paths have not met by then, the oldest is settled on the
+    cheapest path and the paths that disagree are dropped. Latency and
+    memory are therefore bounded whatever the length of the trip.
+
+    One OnlineMatcher follows one vehicle. The TopologyMatcher, with its
+    edge index and path cache, can be shared by all of them; its
+    `maxCandidates` and `beamWidth` limit the search here too.
+    """
+
+    def __init__(self, matcher, window=10):
+        """Initialize with a TopologyMatcher and no positions."""
+        if window < 1:
+            raise ValueError('window must be at least 1')
+        self.matcher = matcher
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        """Forget the current trip without emitting its remaining edges."""
+        self._start = Candidate(self.matcher.graph, start=True)
+        # The last settled candidate, which all paths run through.
+        self._anchor = self._start
+        # The unsettled layers of candidates, oldest first, the cheapest
+        # paths through them as (cost, candidate) pairs and the best
+        # predecessor of each candidate.
+        self._layers = deque()
+        self._paths = []
+        self._predecessor = {}
+        # A short settled edge held back until the next is known, so that
+        # a reversal onto its twin can still be dropped, as in
+        # getMatchedRoutes.
+        self._tail = []
+        self._position = None
+        self._measured = None
+
+    def __len__(self):
+        """Number of unsettled measurements."""
+        return len(self._layers)
+
+    def add(self, x, y):
+        """Add the next position and return the (u, v, key) edges settled.
+
+        Most positions settle no edges, and give an empty list.
+        """
+        last = self._position
+        self._position = x, y
+        if self._measured is not None and math.hypot(
+                x - self._measured[0],
+                y - self._measured[1]) < self.matcher.increment:
+            return []
+        direction = (x - last[0], y - last[1]) if last else (0., 0.)
+        if not self._measure(x, y, direction, terminal=not self._paths):
+            return []
+        return self._settle()
+
+    def finish(self):
+        """End the trip and return all of its remaining edges.
+
+        The last position is always measured, as the end of a line is.
+        The matcher is then ready for a new trip.
+        """
+        if self._position is not None and self._position != self._measured:
+            x, y = self._position
+            self._measure(x, y, (x - self._measured[0], y - self._measured[1])
+                          if self._measured else (0., 0.), terminal=True)
+        edges = []
+        if self._paths:
+            end = Candidate(self.matcher.graph, end=True)
+            _extendPaths(self._paths, [end], self._predecessor,
+                         self.matcher.cache, self.matcher.increment)
+            last = self._predecessor[end]
+            edges = self._emit(self._join(last) + [last.segment], final=True)
+        self.reset()
+        return edges
+
+    def _measure(self, x, y, direction, terminal):
+        """Extend the paths to the candidates of a measurement at x, y.
+
+        Returns False if the measurement has no candidates, in which case
+        it is skipped.
+        """
+        matcher = self.matcher
+        self._measured = x, y
+        layer, = _findCandidates(matcher.graph, matcher.index, np.array([x]),
+                                 np.array([y]), np.array([direction]),
+                                 np.array([terminal]), matcher.scope,
+                                 matcher.maxCandidates)
+        if not layer:
+            return False
+        paths = self._paths or [(self._start.emission_cost(), self._start)]
+        paths = _extendPaths(paths, layer, self._predecessor, matcher.cache,
+                             matcher.increment, matcher.beamWidth)
+        # Only differences in cost matter, so keep them from growing.
+        lowest = paths[0][0]
+        self._paths = [(cost - lowest, c) for cost, c in paths]
+        self._layers.append(layer)
+        return True
+
+    def _settle(self):
+        """Settle the newest measurement that all paths run through."""
+        ancestors = [c for _, c in self._paths]
+        i = len(self._layers) - 1
+        oldest = i - self.window
+        while i >= 0 and len(set(ancestors)) > 1:
+            if i <= oldest:
+                # Too far behind: settle on the cheapest path.
+                self._paths = [p for p, a in zip(self._paths, ancestors)
+                               if a is ancestors[0]]
+                break
+            ancestors = [self._predecessor[a] for a in ancestors]
+            i -= 1
+        if i < 0:
+            return []
+        settled = ancestors[0]
+        sequence = self._join(settled)
+        for _ in range(i + 1):
+            for c in self._layers.popleft():
+                self._predecessor.pop(c, None)
+        self._anchor = settled
+        return self._emit(sequence)
+
+    def _join(self, candidate):
+        """Return the edge ids from the anchor up to the candidate's edge."""
+        chain = [candidate]
+        while chain[-1] is not self._anchor:
+            chain.append(self._predecessor[chain[-1]])
+        chain.reverse()
+        sequence = []
+        for prev, cur in zip(chain[:-1], chain[1:]):
+            if prev is not self._start:
+                sequence += _joinSegments(prev, cur, self.matcher.graph,
+                                          self.matcher.cache)
+        return sequence
+
+    def _emit(self, sequence, final=False):
+        graph = self.matcher.graph
+        sequence = _dropReversals(
+            self._tail + [e for e in sequence if not graph.terminal[e]],
+            graph, self.matcher.increment)
+        self._tail = []
+        if not final and sequence and \
+                graph.length[sequence[-1]] < self.matcher.increment * 4.:
+            self._tail = sequence[-1:]
+            sequence = sequence[:-1]
+        return [graph.edge(e) for e in sequence]
@@ -0,0 +1,267 @@
+"""Module for a compact, array-backed view of the graph used in matching."""
+
+import math
+from itertools import count
+from heapq import heappush, heappop
+import networkx as nx
+import numpy as np
+
+
+class RoutingGraph:
+    """Frozen, array-backed view of a simplified graph.
+
+    Nodes and edges get integer ids. Out-edges are stored in CSR form:
+    the edges leaving node a are ids indptr[a] to indptr[a+1]. Per-edge
+    `src`, `dst`, `key`, `length` and `terminal` arrays, node coordinates
+    and the straight segments of every edge geometry are kept as NumPy
+    arrays, and `edge(e)` maps an edge id back to its (u, v, key) tuple in
+    the original graph. Segments of edge e are rows first[e] to first[e+1]
+    of the segment arrays; `start` is the distance along the edge at which
+    each segment begins.
+
+    `pathSearches` and `treeSearches` count the calls to shortest_path and
+    shortest_paths, for instrumentation.
+    """
+
+    def __init__(self, DG=None):
+        """Initialize from a MultiDiGraph returned by getNetworkTopology."""
+        self.hierarchy = None
+        self.pathSearches = 0
+        self.treeSearches = 0
+        self._nodeIds = None
+        self._edgeIds = None
+        if DG is None:
+            return
+        nodes = list(DG.nodes())
+        ids = dict((n, a) for a, n in enumerate(nodes))
+        edges = sorted(DG.edges(keys=True, data=True),
+                       key=lambda e: ids[e[0]])
+        self._setArrays(
+            nodes,
+            np.array([DG.node[n]['x'] for n in nodes], dtype=float),
+            np.array([DG.node[n]['y'] for n in nodes], dtype=float),
+            np.array([ids[u] for u, _, __, ___ in edges], dtype=np.int64),
+            np.array([ids[v] for _, v, __, ___ in edges], dtype=np.int64),
+            np.array([k for _, __, k, ___ in edges], dtype=np.int64),
+            np.array([d['length'] for _, __, ___, d in edges], dtype=float),
+            np.array([bool(d['terminal']) for _, __, ___, d in edges],
+                     dtype=bool),
+            [np.asarray(d['geom'].coords, dtype=float)[:, :2]
+             for _, __, ___, d in edges])
+        self.hierarchy = DG.graph.get('hierarchy')
+
+    def _setArrays(self, nodes, x, y, src, dst, key, length, terminal,
+                   coords):
+        self.nodes = nodes
+        self.x = x
+        self.y = y
+        self.src = src
+        self.dst = dst
+        self.key = key
+        self.length = length
+        self.terminal = terminal
+        self.indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+        self.indptr[1:] = np.cumsum(np.bincount(src, minlength=len(nodes)))
+
+        # The twin of each edge runs the other way with the same key.
+        twins = dict(((a, b, k), e) for e, (a, b, k) in
+                     enumerate(zip(src.tolist(), dst.tolist(), key.tolist())))
+        self.reverse = np.array([twins.get((b, a, k), -1) for a, b, k in
+                                 zip(src.tolist(), dst.tolist(), key.tolist())],
+                                dtype=np.int64)
+
+        counts = np.array([len(c) - 1 for c in coords], dtype=np.int64)
+        self.first = np.zeros(len(coords) + 1, dtype=np.int64)
+        self.first[1:] = np.cumsum(counts)
+        pts = np.concatenate(coords) if coords else np.zeros((0, 2))
+        # Every point except the last of each edge starts a segment.
+        isStart = np.ones(len(pts), dtype=bool)
+        isStart[np.cumsum(counts + 1) - 1] = False
+        a = pts[isStart]
+        b = pts[np.flatnonzero(isStart) + 1]
+        self.x0, self.y0 = a[:, 0], a[:, 1]
+        self.dx, self.dy = b[:, 0] - a[:, 0], b[:, 1] - a[:, 1]
+        self.segLength = np.hypot(self.dx, self.dy)
+        along = np.cumsum(self.segLength) - self.segLength
+        self.start = along - np.repeat(along[self.first[:-1]], counts)
+
+    def __len__(self):
+        """Number of nodes."""
+        return len(self.nodes)
+
+    def __getstate__(self):
+        """Pickle without the lazily built id lookups."""
+        state = self.__dict__.copy()
+        state['_nodeIds'] = None
+        state['_edgeIds'] = None
+        return state
+
+    def node_id(self, node):
+        """Return the integer id of a node of the original graph."""
+        if self._nodeIds is None:
+            self._nodeIds = dict((n, a) for a, n in enumerate(self.nodes))
+        return self._nodeIds[node]
+
+    def edge(self, e):
+        """Return the (u, v, key) tuple of edge id e."""
+        return (self.nodes[self.src[e]], self.nodes[self.dst[e]],
+                int(self.key[e]))
+
+    def edge_id(self, u, v, key):
+        """Return the edge id of (u, v, key) in the original graph."""
+        if self._edgeIds is None:
+            self._edgeIds = dict(
+                ((self.nodes[a], self.nodes[b], k), e) for e, (a, b, k) in
+                enumerate(zip(self.src.tolist(), self.dst.tolist(),
+                              self.key.tolist())))
+        return self._edgeIds[u, v, key]
+
+    def bounds(self):
+        """Return (minx, miny, maxx, maxy) arrays for every edge."""
+        starts = self.first[:-1]
+        x1, y1 = self.x0 + self.dx, self.y0 + self.dy
+        return (np.minimum.reduceat(np.minimum(self.x0, x1), starts),
+                np.minimum.reduceat(np.minimum(self.y0, y1), starts),
+                np.maximum.reduceat(np.maximum(self.x0, x1), starts),
+                np.maximum.reduceat(np.maximum(self.y0, y1), starts))
+
+    def project(self, eid, x, y):
+        """Project points onto edges, pairwise.
+
+        Returns the offset along and distance from edge eid[k] of point
+        (x[k], y[k]), and the direction of the edge at that offset.
+        """
+        counts = self.first[eid + 1] - self.first[eid]
+        pair = np.repeat(np.arange(len(eid)), counts)
+        groups = np.cumsum(counts) - counts
+        seg = (np.arange(counts.sum()) - np.repeat(groups, counts) +
+               np.repeat(self.first[eid], counts))
+        x0, y0 = self.x0[seg], self.y0[seg]
+        dx, dy = self.dx[seg], self.dy[seg]
+        len2 = dx * dx + dy * dy
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = ((x[pair] - x0) * dx + (y[pair] - y0) * dy) / len2
+        t = np.clip(np.where(len2 > 0, t, 0.), 0., 1.)
+        dist = np.hypot(x0 + t * dx - x[pair], y0 + t * dy - y[pair])
+        # Nearest segment of each pair, the first one on ties.
+        best = np.lexsort((seg, dist, pair))[groups]
+        offset = self.start[seg[best]] + t[best] * self.segLength[seg[best]]
+        return offset, dist[best], dx[best], dy[best]
+
+    def reverse_path(self, sequence):
+        """Return the twin edges of a path in the opposite direction.
+
+        Returns None if any edge on the path has no twin.
+        """
+        reverse = [int(self.reverse[e]) for e in reversed(sequence)]
+        if any(e < 0 for e in reverse):
+            return None
+        return reverse
+
+    def _out(self, a):
+        lo, hi = int(self.indptr[a]), int(self.indptr[a + 1])
+        return zip(range(lo, hi), self.dst[lo:hi].tolist(),
+                   self.length[lo:hi].tolist())
+
+    def shortest_path(self, source, target):
+        """Return the edge ids of a shortest path from source to target.
+
+        Uses the contraction hierarchy if one is set, and A* otherwise.
+        Raises NetworkXNoPath if target cannot be reached.
+        """
+        self.pathSearches += 1
+        if self.hierarchy is not None:
+            path = self.hierarchy.query(self.nodes[source], self.nodes[target])
+            return [self.edge_id(u, v, k) for u, v, k in path]
+        return self._astar(source, target)
+
+    def shortest_paths(self, source, targets, cutoff=float('inf')):
+        """Return shortest edge-id paths from source to each target.
+
+        One search serves all of the targets. It stops once every target is
+        settled or the search passes `cutoff`; targets that were not reached
+        by then are left out of the returned dict.
+        """
+        self.treeSearches += 1
+        if self.hierarchy is not None:
+            routes = self.hierarchy.paths(self.nodes[source],
+                                          [self.nodes[t] for t in targets],
+                                          cutoff)
+            return dict((self.node_id(t), [self.edge_id(u, v, k)
+                                       for u, v, k in path])
+                        for t, path in routes.items())
+        return self._dijkstra(source, targets, cutoff)
+
+    def _astar(self, source, target):
+        # Adapted from the networkx A* search, with the straight-line
+        # distance to the target as heuristic.
+        tx, ty = self.x[target], self.y[target]
+        c = count()
+        queue = [(0, next(c), source, 0, None)]
+        enqueued = {}
+        explored = {}
+        while queue:
+            _, __, curnode, dist, via = heappop(queue)
+            if curnode == target:
+                path = []
+                while via is not None:
+                    path.append(via)
+                    via = explored.get(int(self.src[via]))
+                path.reverse()
+                return path
+            if curnode in explored:
+                continue
+            explored[curnode] = via
+            for e, neighbor, w in self._out(curnode):
+                if neighbor in explored:
+                    continue
+                ncost = dist + w
+                if neighbor in enqueued:
+                    qcost, h = enqueued[neighbor]
+                    if qcost <= ncost:
+                        continue
+                else:
+                    h = math.hypot(self.x[neighbor] - tx,
+                                   self.y[neighbor] - ty)
+                enqueued[neighbor] = ncost, h
+                heappush(queue, (ncost + h, next(c), neighbor, ncost, e))
+        raise nx.NetworkXNoPath('Node {} not reachable from {}'.format(
+            self.nodes[target], self.nodes[source]))
+
+    def _dijkstra(self, source, targets, cutoff):
+        remaining = set(targets)
+        parents = {source: None}
+        dists = {source: 0}
+        settled = set()
+        found = []
+        c = count()
+        queue = [(0, next(c), source)]
+        while queue and remaining:
+            dist, _, curnode = heappop(queue)
+            if dist > cutoff:
+                break
+            if curnode in settled:
+                continue
+            settled.add(curnode)
+            if curnode in remaining:
+                remaining.discard(curnode)
+                found.append(curnode)
+            for e, neighbor, w in self._out(curnode):
+                if neighbor in settled:
+                    continue
+                ncost = dist + w
+                if neighbor not in dists or ncost < dists[neighbor]:
+                    dists[neighbor] = ncost
+                    parents[neighbor] = e
+                    heappush(queue, (ncost, next(c), neighbor))
+
+        paths = {}
+        for target in found:
+            path = []
+            node = target
+            while parents[node] is not None:
+                path.append(parents[node])
+                node = int(self.src[parents[node]])
+            path.reverse()
+            paths[target] = path
+        return paths
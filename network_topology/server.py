@@ -0,0 +1,273 @@
+"""Module for serving match requests from a long-running local process.
+
+The server needs Python 3 and is not imported with the package. Start it
+on a topology written by saveTopology with
+
+    python -m network_topology.server network.topo --socket /tmp/match.sock
+
+Requests and responses are JSON objects, one per line. A request with a
+GeoJSON LineString geometry or feature in 'geometry' gets the matched
+edges as [u, v, key] lists in 'edges', or an 'error'. A request with
+'metrics' set gets the metrics of the server. The 'id' of a request, if
+any, is returned with its response; responses to requests sent on the same
+connection may come back in any order.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from shapely.geometry import shape
+import logging
+
+from .instrument import PipelineStats
+from .match import TopologyMatcher, _initWorker, _matchWorker
+from .storage import loadRoutingGraph
+
+logger = logging.getLogger('network-topology')
+
+# Longest request line accepted, in bytes.
+LINE_LIMIT = 2 ** 24
+# Number of recent requests that latencies and match totals are taken from.
+METRICS_WINDOW = 1000
+
+
+class MatchServer(object):
+    """Matches linestrings sent over a Unix socket or a local TCP port.
+
+    The matcher, with its edge index and path cache, is kept for the life
+    of the server. Requests that arrive within `batchDelay` seconds of one
+    another are matched together, up to `batchSize` at a time, while the
+    next batch queues. With `workers` other than 1, batches are matched
+    on a pool of that many processes (all cores if None), each of which
+    is sent the matcher once, when it starts.
+    """
+
+    def __init__(self, matcher, workers=1, batchSize=64, batchDelay=0.002):
+        """Initialize with a TopologyMatcher; start must be awaited next."""
+        self.matcher = matcher
+        self.workers = workers
+        self.batchSize = batchSize
+        self.batchDelay = batchDelay
+        self.requests = 0
+        self.batches = 0
+        self.errors = 0
+        self._latencies = deque(maxlen=METRICS_WINDOW)
+        self._records = deque(maxlen=METRICS_WINDOW)
+        self._inFlight = 0
+        self._queue = None
+        self._server = None
+        self._batcher = None
+        self._executor = None
+        self._pool = None
+
+    async def start(self, path=None, host='127.0.0.1', port=0):
+        """Listen on the Unix socket `path`, or else on host and port.
+
+        Returns the address listened on, which gives the port chosen when
+        `port` is 0.
+        """
+        self._queue = asyncio.Queue()
+        # Batches are matched one at a time, off the event loop.
+        self._executor = ThreadPoolExecutor(1)
+        if self.workers != 1:
+            self.workers = self.workers or multiprocessing.cpu_count()
+            self._pool = multiprocessing.Pool(self.workers, _initWorker,
+                                              (self.matcher,))
+        self._batcher = asyncio.ensure_future(self._batch())
+        if path is not None:
+            self._server = await asyncio.start_unix_server(
+                self._handle, path, limit=LINE_LIMIT)
+        else:
+            self._server = await asyncio.start_server(
+                self._handle, host, port, limit=LINE_LIMIT)
+        address = self._server.sockets[0].getsockname()
+        logger.info('Serving matches on {}'.format(address))
+        return address
+
+    async def close(self):
+        """Stop listening and shut down the workers."""
+        self._server.close()
+        await self._server.wait_closed()
+        self._batcher.cancel()
+        try:
+            await self._batcher
+        except asyncio.CancelledError:
+            pass
+        self._executor.shutdown()
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+
+    async def match(self, lineString):
+        """Queue a linestring and return its matched (u, v, key) edges."""
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((lineString, future, time.time()))
+        return await future
+
+    def metrics(self):
+        """Return the queue depth, counts and latencies as a dict.
+
+        Latencies, in seconds from the arrival of a request to its match,
+        and the 'match' totals of the PipelineStats records of matching
+        are taken over the last METRICS_WINDOW requests. 'cache' holds the
+        counters of the path cache when matching runs in this process.
+        """
+        latencies = np.array(self._latencies)
+        stats = PipelineStats()
+        for record in self._records:
+            stats.add(record)
+        metrics = OrderedDict([
+            ('queued', self._queue.qsize() if self._queue else 0),
+            ('inFlight', self._inFlight),
+            ('requests', self.requests),
+            ('batches', self.batches),
+            ('errors', self.errors)])
+        if len(latencies):
+            metrics['latency'] = OrderedDict([
+                ('mean', float(latencies.mean())),
+                ('p50', float(np.percentile(latencies, 50))),
+                ('p95', float(np.percentile(latencies, 95))),
+                ('max', float(latencies.max()))])
+        metrics['match'] = stats.totals().get('match')
+        if self._pool is None:
+            metrics['cache'] = self.matcher.cache.stats()
+        return metrics
+
+    async def _batch(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self._queue.get()]
+            if self.batchDelay:
+                await asyncio.sleep(self.batchDelay)
+            while len(batch) < self.batchSize and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            self._inFlight = len(batch)
+            try:
+                results = await loop.run_in_executor(
+                    self._executor, self._matchBatch,
+                    [lineString for lineString, _, __ in batch])
+            except Exception as e:
+                logger.exception('Matching a batch failed')
+                for _, future, __ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                now = time.time()
+                for (_, future, arrived), (path, records) in zip(batch,
+                                                                 results):
+                    if future.done():
+                        continue
+                    if records is None:
+                        # Only this request failed; path is its exception.
+                        future.set_exception(path)
+                        continue
+                    self._latencies.append(now - arrived)
+                    self._records.extend(records)
+                    future.set_result(path)
+            self.requests += len(batch)
+            self.batches += 1
+            self._inFlight = 0
+
+    def _matchBatch(self, lineStrings):
+        items = list(enumerate(lineStrings))
+        if self._pool is None:
+            return [_tryMatch(self.matcher._matchItem, item)
+                    for item in items]
+        chunksize = max(1, len(items) // (4 * self.workers))
+        return self._pool.map(_serveWorker, items, chunksize)
+
+    async def _handle(self, reader, writer):
+        pending = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                task = asyncio.ensure_future(self._respond(line, writer))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+            if pending:
+                await asyncio.wait(pending)
+        finally:
+            writer.close()
+
+    async def _respond(self, line, writer):
+        request = {}
+        try:
+            request = json.loads(line.decode('utf-8'))
+            if request.get('metrics'):
+                response = {'metrics': self.metrics()}
+            else:
+                geometry = request['geometry']
+                if geometry.get('type') == 'Feature':
+                    geometry = geometry['geometry']
+                edges = await self.match(shape(geometry))
+                response = {'edges': [list(edge) for edge in edges]}
+        except Exception as e:
+            self.errors += 1
+            response = {'error': '{}: {}'.format(type(e).__name__, e)}
+        if isinstance(request, dict) and 'id' in request:
+            response['id'] = request['id']
+        writer.write((json.dumps(response) + '\n').encode('utf-8'))
+
+
+def _tryMatch(match, item):
+    """Return match(item), or the exception it raised and None."""
+    try:
+        return match(item)
+    except Exception as e:
+        logger.exception('Matching request {} failed'.format(item[0]))
+        return e, None
+
+
+def _serveWorker(item):
+    return _tryMatch(_matchWorker, item)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Serve match requests for a saved topology.')
+    parser.add_argument('topology', help='file written by saveTopology')
+    parser.add_argument('--socket', help='listen on this Unix socket')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--workers', type=int, default=1,
+                        help='processes for matching (0 for all cores)')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--batch-delay', type=float, default=0.002,
+                        help='seconds to wait for a batch to fill')
+    parser.add_argument('--increment', type=float, default=100.)
+    parser.add_argument('--scope', type=float, default=30.)
+    parser.add_argument('--max-candidates', type=int)
+    parser.add_argument('--beam-width', type=int)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    matcher = TopologyMatcher(loadRoutingGraph(args.topology),
+                              increment=args.increment, scope=args.scope,
+                              maxCandidates=args.max_candidates,
+                              beamWidth=args.beam_width)
+    server = MatchServer(matcher, workers=args.workers or None,
+                         batchSize=args.batch_size,
+                         batchDelay=args.batch_delay)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(server.start(args.socket, args.host, args.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(server.close())
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+"""Module for streaming linestrings from files on disk."""
+
+import json
+from shapely import wkb
+from shapely.geometry import shape
+
+
+def readLineStrings(path):
+    """Yield the linestrings in a file, one per line, without loading it all.
+
+    Each line holds either a GeoJSON geometry or feature, or a hex encoded
+    WKB geometry. Blank lines are skipped. The generator can be passed
+    straight to getNetworkTopology.
+    """
+    with open(path) as fp:
+        for line in fp:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                data = json.loads(line)
+                if data.get('type') == 'Feature':
+                    data = data['geometry']
+                yield shape(data)
+            else:
+                yield wkb.loads(line, hex=True)
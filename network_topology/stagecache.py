@@ -0,0 +1,181 @@
+"""Module for caching the stages of getNetworkTopology on disk."""
+
+import hashlib
+import os
+import tempfile
+import zipfile
+from collections import deque
+import networkx as nx
+import numpy as np
+from rtree import index
+from shapely import wkb
+import logging
+
+logger = logging.getLogger('network-topology')
+
+# Bump whenever a stage starts producing different output, so that entries
+# written by older code are no longer found.
+CACHE_VERSION = 1
+
+
+class StageCache(object):
+    """Content-addressed store for the intermediate results of a build.
+
+    Entries are compressed .npz files in `folder`, named by a key made from
+    the input linestrings and the parameters the cached stages depend on,
+    and by the stage name. The stages are 'shape' (the buffered shape and
+    the line endpoints), 'triangles' (the triangulation arrays), 'polygons'
+    and 'skeleton' (the skeleton graph, before terminals are inserted).
+    Entries are written to a temporary file and renamed into place, so an
+    interrupted run never leaves a partial entry behind; an entry that
+    cannot be read is treated as missing.
+    """
+
+    def __init__(self, folder):
+        """Initialize with the folder to keep entries in."""
+        self.folder = folder
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def key(self, lineStrings, thickness, minInnerPerimeter):
+        """Return the lines and the cache key for building them.
+
+        The lines are read once to hash them, so a one-shot iterator is
+        copied into a list first and that list is returned in its place.
+        """
+        if iter(lineStrings) is lineStrings:
+            lineStrings = list(lineStrings)
+        digest = hashlib.sha1()
+        digest.update('{}:{!r}:{!r}'.format(CACHE_VERSION, float(thickness),
+                                            float(minInnerPerimeter))
+                      .encode('ascii'))
+        for ls in lineStrings:
+            digest.update(ls.wkb)
+        return lineStrings, digest.hexdigest()
+
+    def path(self, key, stage):
+        """Return the file name of a stage entry."""
+        return os.path.join(self.folder, '{}.{}.npz'.format(key, stage))
+
+    def load(self, key, stage):
+        """Return a cached stage result, or None if there is none."""
+        filename = self.path(key, stage)
+        if not os.path.exists(filename):
+            return None
+        try:
+            with np.load(filename) as data:
+                value = _DECODERS[stage](data)
+        except (IOError, ValueError, KeyError, zipfile.BadZipfile):
+            logger.info('Ignoring unreadable cache entry {}'.format(filename))
+            return None
+        logger.info('Loaded {} from cache'.format(stage))
+        return value
+
+    def save(self, key, stage, value):
+        """Store a stage result."""
+        fd, tmp = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                np.savez_compressed(fp, **_ENCODERS[stage](value))
+            os.rename(tmp, self.path(key, stage))
+        except Exception:
+            os.remove(tmp)
+            raise
+
+
+def _encodeShape(value):
+    big_shape, endpoints = value
+    return {'wkb': np.frombuffer(big_shape.wkb, dtype=np.uint8),
+            'endpoints': np.array(endpoints, dtype=float).reshape(-1, 2)}
+
+
+def _decodeShape(data):
+    endpoints = [tuple(p) for p in data['endpoints'].tolist()]
+    return wkb.loads(data['wkb'].tobytes()), endpoints
+
+
+def _encodeTriangles(tri):
+    return dict(tri)
+
+
+def _decodeTriangles(data):
+    return dict((name, data[name]) for name in data.files)
+
+
+def _encodePolygons(polys):
+    sizes = np.array([len(p) for p in polys], dtype=np.int64)
+    flat = [v for p in polys for v in p]
+    return {'sizes': sizes, 'vertices': np.array(flat, dtype=np.int64)}
+
+
+def _decodePolygons(data):
+    ends = np.cumsum(data['sizes'])
+    if not len(ends):
+        return []
+    return [p.tolist() for p in np.split(data['vertices'], ends[:-1])]
+
+
+def _insertionOrder(G):
+    """Return the edges of G in an order that recreates its adjacency.
+
+    Adding the edges in this order gives every node its neighbours in the
+    same order as in G, which the walk in _simplifyGraph depends on. Each
+    node's neighbour list orders the edges at that node, and the edges are
+    sorted topologically under all of those orders together.
+    """
+    edges = list(G.edges(data=True))
+    ids = {}
+    for e, (u, v, _) in enumerate(edges):
+        ids[u, v] = ids[v, u] = e
+    after = [[] for _ in edges]
+    before = [0] * len(edges)
+    for n, nbrs in G.adj.items():
+        chain = [ids[n, m] for m in nbrs]
+        for a, b in zip(chain, chain[1:]):
+            after[a].append(b)
+            before[b] += 1
+    queue = deque(e for e in range(len(edges)) if not before[e])
+    order = []
+    while queue:
+        e = queue.popleft()
+        order.append(edges[e])
+        for f in after[e]:
+            before[f] -= 1
+            if not before[f]:
+                queue.append(f)
+    return order
+
+
+def _encodeSkeleton(G):
+    nodes = list(G.nodes())
+    edges = _insertionOrder(G)
+    return {'nodes': np.array(nodes, dtype=np.int64),
+            'x': np.array([G.node[n]['x'] for n in nodes], dtype=float),
+            'y': np.array([G.node[n]['y'] for n in nodes], dtype=float),
+            'edges': np.array([(u, v) for u, v, _ in edges],
+                              dtype=np.int64).reshape(-1, 2),
+            'ux': np.array([d['ux'] for _, __, d in edges], dtype=float),
+            'uy': np.array([d['uy'] for _, __, d in edges], dtype=float),
+            'terminal': np.array([d['terminal'] for _, __, d in edges],
+                                 dtype=bool)}
+
+
+def _decodeSkeleton(data):
+    node_idx = index.Index()
+    G = nx.Graph(index=node_idx)
+    for n, x, y in zip(data['nodes'].tolist(), data['x'].tolist(),
+                       data['y'].tolist()):
+        G.add_node(n, x=x, y=y)
+        node_idx.insert(n, (x, y, x, y))
+    for (u, v), ux, uy, terminal in zip(data['edges'].tolist(),
+                                        data['ux'].tolist(),
+                                        data['uy'].tolist(),
+                                        data['terminal'].tolist()):
+        G.add_edge(u, v, ux=ux, uy=uy, terminal=terminal)
+    return G
+
+
+_ENCODERS = {'shape': _encodeShape, 'triangles': _encodeTriangles,
+             'polygons': _encodePolygons, 'skeleton': _encodeSkeleton}
+_DECODERS = {'shape': _decodeShape, 'triangles': _decodeTriangles,
+             'polygons': _decodePolygons, 'skeleton': _decodeSkeleton}
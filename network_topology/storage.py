@@ -0,0 +1,184 @@
+"""Module for saving simplified graphs in a compact, memory-mappable file."""
+
+import json
+import struct
+import networkx as nx
+import numpy as np
+from shapely.geometry import LineString, Point
+import logging
+
+from .routing import RoutingGraph
+
+logger = logging.getLogger('network-topology')
+
+MAGIC = b'NETTOPO\x00'
+VERSION = 1
+# Arrays start on multiples of this many bytes, so that mapped arrays are
+# aligned for any dtype.
+ALIGN = 64
+
+# Attributes of a RoutingGraph that are stored as they are.
+_ROUTING_ARRAYS = ('x', 'y', 'src', 'dst', 'key', 'length', 'terminal',
+                   'indptr', 'reverse', 'first', 'x0', 'y0', 'dx', 'dy',
+                   'segLength', 'start')
+
+
+def saveTopology(DG, path):
+    """Write a graph from getNetworkTopology to a single binary file.
+
+    The file holds flat arrays of the node ids and attributes, the edges
+    and their coordinates, and the arrays of the RoutingGraph for DG, so
+    that loadRoutingGraph does no work beyond mapping them. The 'x', 'y',
+    'turn' and 'terminal' node attributes and the 'geom', 'length',
+    'terminal' and 'nnodes' edge attributes are kept; others are not.
+    """
+    logger.info('Saving topology to {}'.format(path))
+    graph = RoutingGraph(DG)
+    arrays = [(name, getattr(graph, name)) for name in _ROUTING_ARRAYS]
+    ids, isInt = _packIds(graph.nodes)
+    arrays.append(('nodes', ids))
+    arrays.append(('nodeIsInt', isInt))
+    arrays.append(('turn', np.array(
+        [DG.node[n].get('turn', -1) for n in graph.nodes], dtype=np.int8)))
+    arrays.append(('nodeTerminal', np.array(
+        [bool(DG.node[n].get('terminal')) for n in graph.nodes],
+        dtype=bool)))
+
+    edges = [DG[graph.nodes[a]][graph.nodes[b]][k] for a, b, k in
+             zip(graph.src.tolist(), graph.dst.tolist(), graph.key.tolist())]
+    coords = [np.asarray(d['geom'].coords, dtype=float)[:, :2]
+              for d in edges]
+    arrays.append(('coordStart', _offsets(len(c) for c in coords)))
+    flat = np.concatenate(coords) if coords else np.zeros((0, 2))
+    arrays.append(('cx', flat[:, 0].copy()))
+    arrays.append(('cy', flat[:, 1].copy()))
+    nnodes = [d.get('nnodes') for d in edges]
+    arrays.append(('hasNnodes', np.array([n is not None for n in nnodes],
+                                         dtype=bool)))
+    arrays.append(('nnodeStart', _offsets(len(n or []) for n in nnodes)))
+    ids, isInt = _packIds([n for path in nnodes for n in path or []])
+    arrays.append(('nnodes', ids))
+    arrays.append(('nnodeIsInt', isInt))
+    _writeArrays(path, arrays)
+    logger.info('Saved topology')
+
+
+def loadTopology(path, mmap=True):
+    """Read a graph written by saveTopology back into a MultiDiGraph.
+
+    Node and edge keys and the stored attributes are restored, with Point
+    and LineString geometries.
+    """
+    logger.info('Loading topology from {}'.format(path))
+    arrays = _readArrays(path, mmap)
+    nodes = _unpackIds(arrays['nodes'], arrays['nodeIsInt'])
+    DG = nx.MultiDiGraph()
+    for n, x, y, turn, terminal in zip(nodes, arrays['x'].tolist(),
+                                       arrays['y'].tolist(),
+                                       arrays['turn'].tolist(),
+                                       arrays['nodeTerminal'].tolist()):
+        data = {'x': x, 'y': y, 'geom': Point(x, y)}
+        if turn >= 0:
+            data['turn'] = bool(turn)
+        if terminal:
+            data['terminal'] = True
+        DG.add_node(n, **data)
+
+    coordStart = arrays['coordStart'].tolist()
+    xy = np.column_stack([arrays['cx'], arrays['cy']])
+    nnodeStart = arrays['nnodeStart'].tolist()
+    nnodes = _unpackIds(arrays['nnodes'], arrays['nnodeIsInt'])
+    for e, (a, b, k, length, terminal, hasNnodes) in enumerate(zip(
+            arrays['src'].tolist(), arrays['dst'].tolist(),
+            arrays['key'].tolist(), arrays['length'].tolist(),
+            arrays['terminal'].tolist(), arrays['hasNnodes'].tolist())):
+        data = {'geom': LineString(xy[coordStart[e]:coordStart[e + 1]]),
+                'length': length, 'terminal': terminal}
+        if hasNnodes:
+            data['nnodes'] = nnodes[nnodeStart[e]:nnodeStart[e + 1]]
+        DG.add_edge(nodes[a], nodes[b], key=k, **data)
+    logger.info('Loaded topology')
+    return DG
+
+
+def loadRoutingGraph(path, mmap=True):
+    """Read the RoutingGraph of a graph written by saveTopology.
+
+    With `mmap`, the arrays are views of the memory-mapped file, so that
+    processes loading the same file share its pages and loading takes
+    little more than reading the node ids.
+    """
+    arrays = _readArrays(path, mmap)
+    graph = RoutingGraph()
+    graph.nodes = _unpackIds(arrays['nodes'], arrays['nodeIsInt'])
+    for name in _ROUTING_ARRAYS:
+        setattr(graph, name, arrays[name])
+    return graph
+
+
+def _offsets(sizes):
+    return np.concatenate([[0], np.cumsum(list(sizes), dtype=np.int64)])\
+        .astype(np.int64)
+
+
+def _packIds(ids):
+    # Node ids are ints, except for the negative float ids given to
+    # terminal nodes; float64 holds both exactly.
+    return (np.array(ids, dtype=float),
+            np.array([not isinstance(n, float) for n in ids], dtype=bool))
+
+
+def _unpackIds(ids, isInt):
+    if isInt.all():
+        return ids.astype(np.int64).tolist()
+    return [int(n) if i else n for n, i in zip(ids.tolist(), isInt.tolist())]
+
+
+def _writeArrays(path, arrays):
+    entries = []
+    offset = 0
+    for name, array in arrays:
+        array = np.ascontiguousarray(array)
+        entries.append([name, array.dtype.str, list(array.shape), offset])
+        offset += _padded(array.nbytes)
+    header = json.dumps({'version': VERSION, 'arrays': entries}).encode(
+        'utf-8')
+    start = _padded(len(MAGIC) + 8 + len(header))
+    with open(path, 'wb') as fp:
+        fp.write(MAGIC)
+        fp.write(struct.pack('<Q', len(header)))
+        fp.write(header)
+        fp.write(b'\0' * (start - fp.tell()))
+        for name, array in arrays:
+            data = np.ascontiguousarray(array).tobytes()
+            fp.write(data)
+            fp.write(b'\0' * (_padded(len(data)) - len(data)))
+
+
+def _readArrays(path, mmap=True):
+    with open(path, 'rb') as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a saved topology'.format(path))
+        size, = struct.unpack('<Q', fp.read(8))
+        header = json.loads(fp.read(size).decode('utf-8'))
+    if header['version'] != VERSION:
+        raise ValueError('Unsupported topology file version {}'.format(
+            header['version']))
+    start = _padded(len(MAGIC) + 8 + size)
+    if mmap:
+        buf = np.memmap(path, dtype=np.uint8, mode='r')
+    else:
+        buf = np.fromfile(path, dtype=np.uint8)
+    arrays = {}
+    for name, dtype, shape, offset in header['arrays']:
+        dtype = np.dtype(dtype)
+        if not np.prod(shape):
+            arrays[name] = np.zeros(shape, dtype=dtype)
+            continue
+        arrays[name] = np.ndarray(tuple(shape), dtype=dtype, buffer=buf,
+                                  offset=start + offset)
+    return arrays
+
+
+def _padded(size):
+    return -(-size // ALIGN) * ALIGN
@@ -1 +1,7 @@
 import testtopo
+import testtiling
+import testmatch
+import testupdate
+import teststorage
+import testonline
+import testserver
@@ -0,0 +1,170 @@
+import unittest
+import networkx as nx
+from network_topology import (getNetworkTopology, TopologyMatcher,
+                              ContractionHierarchy, PathCache, RoutingGraph,
+                              PipelineStats)
+from shapely.geometry import LineString, Point
+
+class MatchTestCase(unittest.TestCase):
+
+    def nearest(self, x, y):
+        return min(self.graph.nodes(),
+                   key=lambda n: self.graph.node[n]['geom'].distance(
+                       Point(x, y)))
+
+    def test_match(self):
+        path = self.matcher.match(self.X[0])
+        nodes = [path[0][0]] + [v for u, v, i in path]
+        self.assertEqual(nodes, [self.nearest(0, 0), self.nearest(250, 250),
+                                 self.nearest(500, 500)],
+                         'incorrect matched path')
+
+    def test_match_many(self):
+        routes = dict(enumerate(self.X))
+        paths = self.matcher.match_many(routes)
+        self.assertEqual(list(paths), list(routes), 'routes out of order')
+        self.assertEqual(paths[1], self.matcher.match(self.X[1]),
+                         'batch and single results differ')
+
+    def test_match_pool(self):
+        graph, first, second = self.loop()
+        routes = dict(enumerate([first, second, first, second]))
+        pooled = TopologyMatcher(graph).match_many(routes, workers=2)
+        self.assertEqual(pooled, TopologyMatcher(graph).match_many(routes),
+                         'pooled and serial results differ')
+
+    def test_match_stats(self):
+        stats = PipelineStats()
+        paths = self.matcher.match_many(dict(enumerate(self.X)), stats=stats)
+        self.assertEqual([r['route'] for r in stats.records], [0, 1],
+                         'incorrect route records')
+        for record in stats.records:
+            self.assertEqual(record['stage'], 'match')
+            self.assertEqual(record['edges'], len(paths[record['route']]))
+            self.assertGreater(record['candidates'], 0, 'no candidates')
+        self.assertEqual(stats.totals()['match']['runs'], 2)
+
+    def test_match_gap(self):
+        graph = getNetworkTopology([LineString([[0, 0], [500, 0]]),
+                                    LineString([[0, 300], [500, 300]])])
+        path = TopologyMatcher(graph).match(
+            LineString([[0, 0], [500, 0], [500, 300], [0, 300]]))
+        ys = [graph.node[n]['y'] for u, v, i in path for n in (u, v)]
+        self.assertTrue(ys[0] < 10 and ys[-1] > 290, 'gap not matched')
+
+    def test_match_cutoff_gap(self):
+        # The roads only meet far beyond the search radius of the jump.
+        graph = getNetworkTopology(
+            [LineString([[0, 0], [4000, 0], [4000, 300], [0, 300]])] +
+            [LineString([[x, y - 100], [x, y + 100]])
+             for x in (250, 750) for y in (0, 300)], turnThreshold=90)
+        path = TopologyMatcher(graph).match(
+            LineString([[0, 0], [500, 0], [500, 300], [0, 300]]))
+        ys = [graph.node[n]['y'] for u, v, i in path for n in (u, v)]
+        self.assertTrue(ys[0] < 10 and ys[-1] > 290, 'gap not matched')
+
+    def loop(self):
+        """Return a loop road with stubs and two routes that share nodes.
+
+        The first route searches the second's detour with a smaller cutoff.
+        """
+        graph = getNetworkTopology(
+            [LineString([[0, 0], [1000, 0], [1000, 1000], [0, 1000],
+                         [0, 0]])] +
+            [LineString([[x, -200], [x, 0]]) for x in (250, 500, 750)] +
+            [LineString([[1000, y], [1200, y]]) for y in (250, 500, 750)],
+            turnThreshold=90)
+        first = LineString([[250, -10], [250, -190], [1040, 750],
+                            [1000, 750]])
+        second = LineString([[1190, 750], [1000, 750], [1170, 750],
+                             [1000, 750], [0, 440], [0, 590]])
+        return graph, first, second
+
+    def test_match_off_network(self):
+        offNetwork = LineString([[5000, 5000], [5600, 5000]])
+        self.assertEqual(self.matcher.match(offNetwork), [],
+                         'off-network line matched')
+        matcher = TopologyMatcher(self.graph, beamWidth=2)
+        self.assertEqual(matcher.match(offNetwork), [],
+                         'off-network line matched with beam search')
+
+    def test_match_history(self):
+        graph, first, second = self.loop()
+        expected = TopologyMatcher(graph).match(second)
+        matcher = TopologyMatcher(graph)
+        matcher.match(first)
+        self.assertEqual(matcher.match(second), expected,
+                         'result depends on earlier routes')
+
+    def test_match_beam(self):
+        matcher = TopologyMatcher(self.graph, maxCandidates=2, beamWidth=2)
+        for ls in self.X + [LineString([[0, 0], [250, 250], [0, 500]])]:
+            self.assertEqual(matcher.match(ls), self.matcher.match(ls),
+                             'beam and exhaustive results differ')
+
+    def test_hierarchy(self):
+        hierarchy = ContractionHierarchy(self.graph)
+
+        def length(path):
+            return sum(self.graph[u][v][i]['length'] for u, v, i in path)
+
+        for source in self.graph:
+            for target in self.graph:
+                if source == target:
+                    continue
+                expected = nx.dijkstra_path_length(self.graph, source, target,
+                                                   weight='length')
+                path = hierarchy.query(source, target)
+                self.assertAlmostEqual(length(path), expected)
+                self.assertEqual(path[0][0], source, 'incorrect path start')
+                self.assertEqual(path[-1][1], target, 'incorrect path end')
+
+    def test_path_cache(self):
+        cache = PathCache(maxsize=2)
+        cache.add([0, 1, 2, 3], [1., 2., 3.], [10, 11, 12])
+        cache[7, 8] = float('inf'), []
+        self.assertEqual(len(cache), 2, 'incorrect number of paths')
+        self.assertEqual(cache[7, 8], (float('inf'), []))
+        self.assertTrue((1, 3) in cache, 'subpath not found')
+        self.assertEqual(cache[1, 3], (5., [11, 12]))
+        self.assertFalse((3, 1) in cache, 'reversed subpath found')
+        cache.add([4, 5], [1.], [13])
+        self.assertEqual(cache.evictions, 1, 'incorrect number of evictions')
+        self.assertTrue((0, 2) in cache, 'recently used path evicted')
+        self.assertFalse((7, 8) in cache, 'evicted path still cached')
+        self.assertEqual(cache.stats()['hits'], 2, 'incorrect hit count')
+        self.assertEqual(cache.stats()['misses'], 2, 'incorrect miss count')
+        cache.add_unreachable(5, 6, 300.)
+        cache.add_unreachable(5, 6, 200.)
+        self.assertTrue(cache.unreachable(5, 6, 300.), 'cutoff not kept')
+        self.assertFalse(cache.unreachable(5, 6, 400.),
+                         'unreachable beyond the cutoff searched')
+        self.assertFalse(cache.unreachable(6, 5, 100.),
+                         'reversed pair unreachable')
+
+    def test_routing_graph(self):
+        graph = RoutingGraph(self.graph)
+        self.assertEqual(len(graph), len(self.graph), 'incorrect node count')
+        for e in range(len(graph.src)):
+            u, v, i = graph.edge(e)
+            self.assertEqual(graph.edge_id(u, v, i), e, 'incorrect edge id')
+            self.assertAlmostEqual(graph.length[e],
+                                   self.graph[u][v][i]['length'])
+            self.assertEqual(graph.edge(graph.reverse[e]), (v, u, i),
+                             'incorrect twin edge')
+        for source in self.graph:
+            for target in self.graph:
+                path = graph.shortest_path(graph.node_id(source),
+                                           graph.node_id(target))
+                expected = nx.dijkstra_path_length(self.graph, source, target,
+                                                   weight='length')
+                self.assertAlmostEqual(graph.length[path].sum(), expected)
+
+    def setUp(self):
+        self.X = [LineString([[0, 0], [500, 500]]),
+                  LineString([[500, 0], [0, 500]])]
+        self.graph = getNetworkTopology(self.X, turnThreshold=90)
+        self.matcher = TopologyMatcher(self.graph)
+
+if __name__ == '__main__':
+    unittest.main()
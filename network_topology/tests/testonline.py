@@ -0,0 +1,44 @@
+import unittest
+from network_topology import (getNetworkTopology, TopologyMatcher,
+                              OnlineMatcher)
+from shapely.geometry import LineString
+
+class OnlineTestCase(unittest.TestCase):
+
+    def stream(self, matcher, ls):
+        edges = []
+        for d in range(0, int(ls.length), 10):
+            x, y = ls.interpolate(d).coords[0]
+            edges += matcher.add(x, y)
+            self.assertTrue(len(matcher) <= matcher.window,
+                            'too many unsettled measurements')
+        x, y = ls.coords[-1]
+        edges += matcher.add(x, y)
+        return edges + matcher.finish()
+
+    def test_online(self):
+        online = OnlineMatcher(self.matcher)
+        for ls in self.X + [LineString([[0, 0], [250, 250], [0, 500]])]:
+            self.assertEqual(self.stream(online, ls), self.matcher.match(ls),
+                             'online and offline results differ')
+
+    def test_window(self):
+        online = OnlineMatcher(self.matcher, window=1)
+        edges = []
+        for x in range(0, 1000, 10):
+            edges += online.add(x, 0)
+            self.assertTrue(len(online) <= 1, 'window exceeded')
+        self.assertTrue(edges, 'no edges settled before the end')
+        edges += online.finish()
+        self.assertEqual(edges, self.matcher.match(
+            LineString([[0, 0], [990, 0]])))
+
+    def setUp(self):
+        self.X = [LineString([[0, 0], [500, 500]]),
+                  LineString([[500, 0], [0, 500]]),
+                  LineString([[0, 0], [1000, 0]])]
+        self.graph = getNetworkTopology(self.X, turnThreshold=90)
+        self.matcher = TopologyMatcher(self.graph)
+
+if __name__ == '__main__':
+    unittest.main()
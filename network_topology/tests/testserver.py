@@ -0,0 +1,95 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from network_topology import getNetworkTopology, TopologyMatcher
+from shapely.geometry import LineString, Polygon, mapping
+try:
+    import asyncio
+    from network_topology.server import MatchServer
+except (ImportError, SyntaxError):
+    MatchServer = None
+
+@unittest.skipIf(MatchServer is None, 'asyncio is not available')
+class ServerTestCase(unittest.TestCase):
+
+    def run_client(self, requests, path=None):
+        async def client():
+            address = await self.server.start(path=path)
+            try:
+                if path is None:
+                    reader, writer = await asyncio.open_connection(*address)
+                else:
+                    reader, writer = await asyncio.open_unix_connection(path)
+                writer.write(b''.join(json.dumps(r).encode('utf-8') + b'\n'
+                                      for r in requests))
+                responses = [json.loads((await reader.readline()).decode())
+                             for _ in requests]
+                writer.write(b'{"metrics": true}\n')
+                metrics = json.loads((await reader.readline()).decode())
+                writer.close()
+            finally:
+                await self.server.close()
+            return dict((r['id'], r) for r in responses), metrics['metrics']
+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(client())
+        finally:
+            loop.close()
+
+    def test_batched(self):
+        requests = [{'id': i, 'geometry': mapping(ls)}
+                    for i, ls in enumerate(self.X)]
+        requests.append({'id': 'bad', 'geometry': {'type': 'Point'}})
+        responses, metrics = self.run_client(requests)
+        for i, ls in enumerate(self.X):
+            self.assertEqual([tuple(e) for e in responses[i]['edges']],
+                             self.matcher.match(ls), 'incorrect edges')
+        self.assertTrue('error' in responses['bad'], 'error not returned')
+        self.assertEqual(metrics['requests'], 2, 'incorrect request count')
+        self.assertEqual(metrics['batches'], 1, 'requests not batched')
+        self.assertEqual(metrics['errors'], 1, 'incorrect error count')
+        self.assertEqual(metrics['queued'], 0, 'requests left queued')
+        self.assertEqual(metrics['match']['runs'], 2)
+
+    def test_failed_request(self):
+        # A polygon parses, but fails in matching, in the same batch.
+        polygon = Polygon([[0, 0], [500, 0], [500, 500]])
+        requests = [{'id': i, 'geometry': mapping(g)}
+                    for i, g in enumerate(self.X + [polygon])]
+        for workers in (1, 2):
+            self.server = MatchServer(TopologyMatcher(self.graph),
+                                      workers=workers, batchDelay=0.05)
+            responses, metrics = self.run_client(requests)
+            self.assertEqual(metrics['batches'], 1, 'requests not batched')
+            for i, ls in enumerate(self.X):
+                self.assertEqual([tuple(e) for e in responses[i]['edges']],
+                                 self.matcher.match(ls), 'incorrect edges')
+            self.assertTrue('error' in responses[2], 'error not returned')
+            self.assertEqual(metrics['errors'], 1, 'incorrect error count')
+
+    @unittest.skipIf(not hasattr(asyncio, 'start_unix_server'),
+                     'Unix sockets are not available')
+    def test_unix_socket(self):
+        folder = tempfile.mkdtemp()
+        try:
+            responses, metrics = self.run_client(
+                [{'id': 0, 'geometry': mapping(self.X[0])}],
+                path=os.path.join(folder, 'match.sock'))
+        finally:
+            shutil.rmtree(folder)
+        self.assertEqual([tuple(e) for e in responses[0]['edges']],
+                         self.matcher.match(self.X[0]), 'incorrect edges')
+
+    def setUp(self):
+        self.X = [LineString([[0, 0], [500, 500]]),
+                  LineString([[500, 0], [0, 500]])]
+        self.graph = getNetworkTopology(self.X, turnThreshold=90)
+        self.matcher = TopologyMatcher(self.graph)
+        self.server = MatchServer(TopologyMatcher(self.graph),
+                                  batchDelay=0.05)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+from network_topology import (getNetworkTopology, saveTopology, loadTopology,
+                              loadRoutingGraph, RoutingGraph)
+from shapely.geometry import LineString, Point
+
+class StorageTestCase(unittest.TestCase):
+
+    def test_round_trip(self):
+        graph = loadTopology(self.path)
+        self.assertEqual(list(graph.nodes()), list(self.graph.nodes()),
+                         'node ids differ')
+        self.assertEqual(sorted(graph.edges(keys=True)),
+                         sorted(self.graph.edges(keys=True)), 'edges differ')
+        for n, data in self.graph.nodes(data=True):
+            self.assertEqual(graph.node[n]['x'], data['x'])
+            self.assertEqual(graph.node[n].get('terminal'),
+                             data.get('terminal'))
+            self.assertTrue(graph.node[n]['geom'].equals(data['geom']))
+        for u, v, k, data in self.graph.edges(keys=True, data=True):
+            loaded = graph[u][v][k]
+            self.assertEqual(list(loaded['geom'].coords),
+                             list(data['geom'].coords), 'geometry differs')
+            self.assertEqual(loaded['length'], data['length'])
+            self.assertEqual(loaded['terminal'], data['terminal'])
+            self.assertEqual(loaded['nnodes'], data['nnodes'])
+
+    def test_routing_graph(self):
+        expected = RoutingGraph(self.graph)
+        for mmap in (True, False):
+            graph = loadRoutingGraph(self.path, mmap=mmap)
+            self.assertEqual(graph.nodes, expected.nodes, 'node ids differ')
+            for name in ('src', 'dst', 'key', 'reverse', 'indptr', 'x0',
+                         'start'):
+                self.assertTrue(np.array_equal(getattr(graph, name),
+                                               getattr(expected, name)),
+                                '{} differs'.format(name))
+            self.assertEqual(graph.shortest_path(0, len(graph) - 1),
+                             expected.shortest_path(0, len(graph) - 1))
+
+    def setUp(self):
+        X = [LineString([[0, 0], [500, 500]]),
+             LineString([[500, 0], [0, 500]])]
+        self.graph = getNetworkTopology(X, turnThreshold=90,
+                                        splitAtTeriminals=[Point(0, 0)])
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        saveTopology(self.graph, self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+if __name__ == '__main__':
+    unittest.main()
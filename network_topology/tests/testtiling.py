@@ -0,0 +1,53 @@
+import unittest
+from network_topology import getNetworkTopology, getTiledNetworkTopology
+from shapely.geometry import LineString
+
+class TiledTestCase(unittest.TestCase):
+
+    def test_X(self):
+        ntX = getTiledNetworkTopology(self.X, tileSize=40, overlap=20,
+                                      workers=1, turnThreshold=90)
+        self.assertEqual(len(ntX), 5, 'incorrect number of nodes')
+        self.assertEqual(len(ntX.edges()), 8, 'incorrect number of edges')
+
+    def test_T(self):
+        ntT = getTiledNetworkTopology(self.T, tileSize=40, overlap=20,
+                                      workers=1, turnThreshold=90)
+        self.assertEqual(len(ntT), 4, 'incorrect number of nodes')
+        self.assertEqual(len(ntT.edges()), 6, 'incorrect number of edges')
+
+    def test_I(self):
+        ntI = getTiledNetworkTopology(self.I, tileSize=40, overlap=20,
+                                      workers=1, turnThreshold=90)
+        self.assertEqual(len(ntI), 2, 'incorrect number of nodes')
+        self.assertEqual(len(ntI.edges()), 2, 'incorrect number of edges')
+
+    def test_single_pass(self):
+        # The seams of every tile size cross the roads, one of which loops
+        # back through a junction, and another crosses itself.
+        for lines in (self.L, self.S):
+            single = getNetworkTopology(lines, turnThreshold=90)
+            for tileSize in (40, 60, 75):
+                tiled = getTiledNetworkTopology(lines, tileSize=tileSize,
+                                                overlap=200, workers=1,
+                                                turnThreshold=90)
+                self.assertEqual(len(tiled), len(single),
+                                 'incorrect number of nodes')
+                self.assertEqual(len(tiled.edges()), len(single.edges()),
+                                 'incorrect number of edges')
+
+    def setUp(self):
+        self.I = [LineString([[0, 0], [100, 100]]),
+                  LineString([[20, 20], [70, 70]])]
+        self.X = [LineString([[0, 0], [100, 100]]),
+                  LineString([[100, 0], [0, 100]])]
+        self.T = [LineString([[0, 0], [100, 100]]),
+                  LineString([[100, 0], [60, 50], [100, 100]])]
+        self.L = [LineString([[0, 33], [200, 33]]),
+                  LineString([[97, 0], [97, 200]]),
+                  LineString([[0, 105], [153, 105], [153, 171], [73, 171],
+                              [73, 57], [200, 57]])]
+        self.S = [LineString([[0, 7], [200, 193], [200, 3], [0, 200]])]
+
+if __name__ == '__main__':
+    unittest.main()
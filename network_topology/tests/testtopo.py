@@ -1,6 +1,14 @@
+import os
+import json
+import shutil
+import tempfile
 import unittest
-from network_topology import getNetworkTopology
-from shapely.geometry import LineString
+from network_topology import (getNetworkTopology, readLineStrings,
+                              PipelineStats)
+from network_topology.topo import _outerBoundary, _traceBoundary
+from collections import OrderedDict
+import numpy as np
+from shapely.geometry import LineString, mapping
 
 class FullTestCase(unittest.TestCase):
 
@@ -24,6 +32,118 @@ class FullTestCase(unittest.TestCase):
         self.assertEqual(len(ntP), 5, 'incorrect number of nodes')
         self.assertEqual(len(ntP.edges()), 10, 'incorrect number of edges')
 
+    def test_repeatable(self):
+        first = getNetworkTopology(self.O)
+        second = getNetworkTopology(self.O)
+        self.assertEqual(sorted(first.nodes()), sorted(second.nodes()),
+                         'node ids differ between runs')
+        self.assertEqual(sorted(first.edges()), sorted(second.edges()),
+                         'edges differ between runs')
+
+    def test_chunked(self):
+        ntX = getNetworkTopology(iter(self.X), turnThreshold=90, chunkSize=1)
+        self.assertEqual(len(ntX), 5, 'incorrect number of nodes')
+        self.assertEqual(len(ntX.edges()), 8, 'incorrect number of edges')
+
+    def test_parallel_union(self):
+        ntX = getNetworkTopology(self.X, turnThreshold=90, workers=2)
+        self.assertEqual(len(ntX), 5, 'incorrect number of nodes')
+        self.assertEqual(len(ntX.edges()), 8, 'incorrect number of edges')
+
+    def test_parallel_union_origin(self):
+        # Union cells on both sides of the origin, -1 and 0 in x.
+        lines = [LineString([[x + dx, y] for x, y in ls.coords])
+                 for dx in (-3050, 2950) for ls in self.X]
+        ntX = getNetworkTopology(lines, turnThreshold=90, workers=2)
+        self.assertEqual(len(ntX), 10, 'incorrect number of nodes')
+        self.assertEqual(len(ntX.edges()), 16, 'incorrect number of edges')
+
+    def test_pinched_boundary(self):
+        # Two squares that touch at vertex 2, and a hole in the first.
+        vertices = np.array([[0, 0], [1, 0], [1, 1], [0, 1], [2, 1], [2, 2],
+                             [1, 2], [.2, .2], [.2, .8], [.8, .2]])
+        edges = [(0, 1), (1, 2), (2, 3), (3, 0), (2, 4), (4, 5), (5, 6),
+                 (6, 2), (7, 8), (8, 9), (9, 7)]
+        succ = OrderedDict()
+        for a, b in edges:
+            succ.setdefault(a, []).append(b)
+        loop = _outerBoundary(succ, vertices)
+        self.assertEqual(sorted(loop), [0, 1, 2, 2, 3, 4, 5, 6],
+                         'incorrect boundary')
+        self.assertEqual(sorted(zip(loop, loop[1:] + loop[:1])),
+                         sorted(edges[:8]), 'boundary edges not followed')
+
+    def test_annulus_boundary(self):
+        # Four shapes around a square hole with more vertices than the
+        # outside, 10 to 17, which runs clockwise.
+        angles = np.radians(225 + 45 * np.arange(8))
+        vertices = np.zeros((18, 2))
+        vertices[:4] = [[0, 0], [10, 0], [10, 10], [0, 10]]
+        vertices[10:] = np.column_stack([5 + 2 * np.cos(angles),
+                                         5 + 2 * np.sin(angles)])
+        polys = [[k, (k + 1) % 4, 10 + (2 * k + 2) % 8, 11 + 2 * k, 10 + 2 * k]
+                 for k in range(4)]
+        loop = _traceBoundary(range(4), polys, vertices)
+        self.assertEqual(sorted(loop), [0, 1, 2, 3], 'hole traced')
+
+    def test_read(self):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(json.dumps({'type': 'Feature', 'properties': {},
+                                 'geometry': mapping(self.X[0])}) + '\n')
+            fp.write(self.X[1].wkb_hex + '\n')
+        try:
+            lineStrings = list(readLineStrings(path))
+        finally:
+            os.remove(path)
+        self.assertEqual([ls.coords[:] for ls in lineStrings],
+                         [ls.coords[:] for ls in self.X])
+
+    def test_stage_cache(self):
+        folder = tempfile.mkdtemp()
+        try:
+            first = getNetworkTopology(self.T, turnThreshold=90,
+                                       cacheFolder=folder)
+            self.assertEqual(len(os.listdir(folder)), 4,
+                             'stages were not cached')
+            second = getNetworkTopology(iter(self.T), turnThreshold=90,
+                                        cacheFolder=folder)
+            coarse = getNetworkTopology(self.T, turnThreshold=1,
+                                        cacheFolder=folder)
+        finally:
+            shutil.rmtree(folder)
+        self.assertEqual(sorted(first.edges()), sorted(second.edges()),
+                         'cached run differs')
+        self.assertGreater(len(coarse), len(first),
+                           'turnThreshold ignored on cached run')
+
+    def test_debug_dump(self):
+        folder = tempfile.mkdtemp()
+        try:
+            getNetworkTopology(self.X, turnThreshold=90, debugFolder=folder)
+            with open(os.path.join(folder, 'triangles.geojsonl')) as fp:
+                features = [json.loads(line) for line in fp]
+            self.assertTrue(os.path.exists(
+                os.path.join(folder, 'polygons.geojsonl')))
+        finally:
+            shutil.rmtree(folder)
+        self.assertTrue(features, 'no triangles written')
+        for feature in features:
+            ring = feature['geometry']['coordinates'][0]
+            self.assertEqual(len(ring), 4, 'incorrect triangle ring')
+            self.assertEqual(ring[0], ring[-1], 'ring not closed')
+
+    def test_stats(self):
+        records = []
+        stats = PipelineStats(callback=records.append)
+        ntX = getNetworkTopology(self.X, turnThreshold=90, stats=stats)
+        self.assertEqual([r['stage'] for r in records],
+                         ['buffer', 'triangulate', 'polygonize', 'skeleton',
+                          'simplify'], 'incorrect stages')
+        self.assertEqual(records[0]['lines'], 2, 'incorrect line count')
+        self.assertEqual(records[-1]['edges'], len(ntX.edges()),
+                         'incorrect edge count')
+
     def setUp(self):
         self.P = [LineString([[0, 0], [0, 100]]),
                   LineString([[0, 50], [25, 75], [0, 100]])]
@@ -33,6 +153,8 @@ class FullTestCase(unittest.TestCase):
                   LineString([[100, 0], [0, 100]])]
         self.T = [LineString([[0, 0], [100, 100]]),
                   LineString([[100, 0], [60, 50], [100, 100]])]
+        self.O = [LineString([[0, 0], [300, 0], [300, 300], [0, 300],
+                              [0, 0]])]
 
 if __name__ == '__main__':
     unittest.main()
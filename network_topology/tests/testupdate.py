@@ -0,0 +1,44 @@
+import unittest
+from network_topology import getNetworkTopology, updateNetworkTopology
+from shapely.geometry import LineString
+
+class UpdateTestCase(unittest.TestCase):
+
+    def assertSameTopology(self, graph, expected):
+        self.assertEqual(len(graph), len(expected), 'incorrect number of nodes')
+        self.assertEqual(len(graph.edges()), len(expected.edges()),
+                         'incorrect number of edges')
+
+    def assertKeptFarNodes(self, graph, old):
+        for n, data in old.nodes(data=True):
+            if data['x'] > 1000:
+                self.assertTrue(n in graph, 'node id not kept')
+                self.assertEqual(graph.node[n]['x'], data['x'])
+                self.assertEqual(graph.node[n]['y'], data['y'])
+
+    def test_add(self):
+        old = getNetworkTopology(self.far + self.X[:1], turnThreshold=90)
+        lineStrings = self.far + self.X
+        graph = updateNetworkTopology(old, lineStrings, added=self.X[1:],
+                                      overlap=50, turnThreshold=90)
+        self.assertSameTopology(graph, getNetworkTopology(lineStrings,
+                                                          turnThreshold=90))
+        self.assertKeptFarNodes(graph, old)
+
+    def test_remove(self):
+        old = getNetworkTopology(self.far + self.X, turnThreshold=90)
+        lineStrings = self.far + self.X[:1]
+        graph = updateNetworkTopology(old, lineStrings, removed=self.X[1:],
+                                      overlap=50, turnThreshold=90)
+        self.assertSameTopology(graph, getNetworkTopology(lineStrings,
+                                                          turnThreshold=90))
+        self.assertKeptFarNodes(graph, old)
+
+    def setUp(self):
+        self.X = [LineString([[0, 0], [100, 100]]),
+                  LineString([[100, 0], [0, 100]])]
+        self.far = [LineString([[2000, 0], [2100, 100]]),
+                    LineString([[2100, 0], [2000, 100]])]
+
+if __name__ == '__main__':
+    unittest.main()
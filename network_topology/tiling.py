@@ -0,0 +1,320 @@
+"""Module for building the network topology in parallel, tile by tile."""
+
+import math
+import multiprocessing
+from collections import namedtuple
+from itertools import count
+import networkx as nx
+from rtree import index
+from shapely.geometry import LineString, Point, box
+from shapely.ops import clip_by_rect
+import logging
+
+from .topo import getNetworkTopology
+
+logger = logging.getLogger('network-topology')
+
+_EPS = 1e-9
+
+# Placeholder for the point where an edge was cut by a tile boundary.
+_SeamPoint = namedtuple('_SeamPoint', ['x', 'y'])
+
+
+def getTiledNetworkTopology(lineStrings, tileSize=5000.0, overlap=None,
+                            workers=None, thickness=14.0,
+                            splitAtTeriminals=None, turnThreshold=20.0,
+                            minInnerPerimeter=200):
+    """Generate the network topology in overlapping tiles and stitch them.
+
+    Each tile is built with getNetworkTopology from the linestrings clipped
+    to the tile grown by `overlap`, then trimmed back to the tile itself so
+    that artefacts of the clipping stay out of the result. Edges cut by a
+    tile boundary are joined back together with their counterparts from
+    the neighbouring tile.
+
+    Across the seams the nodes and edges are those of a single-pass build,
+    given an `overlap` of at least `minInnerPerimeter` so that tiles fill
+    the same holes. Each tile is triangulated on its own, though, so the
+    pass-through nodes kept at sharp kinks in the skeleton, which arise
+    beside junctions, can still differ from a single pass.
+    """
+    lineStrings = list(lineStrings)
+    if overlap is None:
+        overlap = max(20.0 * thickness, minInnerPerimeter)
+    params = {'thickness': thickness,
+              'turnThreshold': turnThreshold,
+              'minInnerPerimeter': minInnerPerimeter}
+    cores = _tileBounds(lineStrings, tileSize, overlap + thickness)
+    logger.info('Building topology in {} tiles'.format(len(cores)))
+    tasks = _tileTasks(lineStrings, cores, overlap, params,
+                       splitAtTeriminals)
+    if workers == 1:
+        results = [_buildTile(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = list(pool.imap_unordered(_buildTile, tasks))
+        finally:
+            pool.close()
+            pool.join()
+    results.sort(key=lambda result: result[0])
+    logger.info('Stitching tiles')
+    graph = _assemble([(nodes, edges, False) for _, nodes, edges in results],
+                      thickness / 2.0, thickness / 100.0)
+    logger.info('Stitching complete')
+    return graph
+
+
+def _tileBounds(lineStrings, tileSize, margin):
+    minx, miny, maxx, maxy = _totalBounds(lineStrings)
+    cols = max(1, int(math.ceil((maxx - minx) / tileSize)))
+    rows = max(1, int(math.ceil((maxy - miny) / tileSize)))
+    cores = []
+    for row in range(rows):
+        for col in range(cols):
+            x0 = minx + col * tileSize
+            y0 = miny + row * tileSize
+            x1 = x0 + tileSize
+            y1 = y0 + tileSize
+            # Outer tiles reach past the data so every point has one owner.
+            if col == 0:
+                x0 -= margin
+            if row == 0:
+                y0 -= margin
+            if col == cols - 1:
+                x1 = max(x1, maxx) + margin
+            if row == rows - 1:
+                y1 = max(y1, maxy) + margin
+            cores.append((x0, y0, x1, y1))
+    return cores
+
+
+def _totalBounds(geoms):
+    bounds = [g.bounds for g in geoms]
+    return (min(b[0] for b in bounds), min(b[1] for b in bounds),
+            max(b[2] for b in bounds), max(b[3] for b in bounds))
+
+
+def _tileTasks(lineStrings, cores, overlap, params, terminals):
+    idx = index.Index((i, ls.bounds, None)
+                      for i, ls in enumerate(lineStrings))
+    for t, (x0, y0, x1, y1) in enumerate(cores):
+        padded = box(x0 - overlap, y0 - overlap, x1 + overlap, y1 + overlap)
+        parts = []
+        for i in sorted(idx.intersection(padded.bounds)):
+            # Unlike intersection, clip_by_rect does not split lines where
+            # they cross themselves, which would add line ends to the tile.
+            parts.extend(_lineParts(clip_by_rect(lineStrings[i],
+                                                 *padded.bounds)))
+        if not parts:
+            continue
+        points = [p for p in terminals or [] if padded.intersects(p)]
+        yield t, (x0, y0, x1, y1), parts, points, params
+
+
+def _buildTile(task):
+    t, core, parts, points, params = task
+    DG = getNetworkTopology(parts, splitAtTeriminals=points or None,
+                            **params)
+    x0, y0, x1, y1 = core
+
+    def inside(x, y):
+        return x0 <= x < x1 and y0 <= y < y1
+
+    nodes, edges = _clipGraph(DG, box(*core), inside)
+    return t, nodes, edges
+
+
+def _lineParts(geom):
+    if geom.is_empty:
+        return []
+    if geom.geom_type == 'LineString':
+        return [geom] if geom.length > 0 else []
+    if hasattr(geom, 'geoms'):
+        parts = []
+        for g in geom.geoms:
+            parts.extend(_lineParts(g))
+        return parts
+    return []
+
+
+def _clipGraph(DG, area, inside):
+    """Return the nodes and edges of DG that fall within area.
+
+    `inside(x, y)` decides which nodes are kept. Edges crossing the boundary
+    of area are cut there, and the cut ends are given _SeamPoint endpoints.
+    """
+    kept = set(n for n, d in DG.nodes(data=True) if inside(d['x'], d['y']))
+    nodes = [(n, DG.node[n]) for n in kept]
+    edges = []
+    for u, v, data in DG.edges(data=True):
+        geom = data['geom']
+        attrs = dict((k, val) for k, val in data.items() if k != 'nnodes')
+        if u in kept and v in kept and area.contains(geom):
+            edges.append((u, v, attrs))
+            continue
+        if not area.intersects(geom):
+            continue
+        for piece in _lineParts(geom.intersection(area)):
+            # Project points within the piece, as both ends of a loop
+            # project to the start of geom.
+            a = geom.project(piece.interpolate(0.25, normalized=True))
+            b = geom.project(piece.interpolate(0.75, normalized=True))
+            if a > b:
+                piece = LineString(piece.coords[::-1])
+            if u in kept and _atPoint(piece.coords[0], geom.coords[0]):
+                start = u
+            else:
+                start = _SeamPoint(*piece.coords[0][:2])
+            if v in kept and _atPoint(piece.coords[-1], geom.coords[-1]):
+                end = v
+            else:
+                end = _SeamPoint(*piece.coords[-1][:2])
+            edges.append((start, end, dict(attrs, geom=piece,
+                                           length=piece.length)))
+    return nodes, edges
+
+
+def _atPoint(p, q):
+    return abs(p[0] - q[0]) <= _EPS and abs(p[1] - q[1]) <= _EPS
+
+
+def _assemble(parts, tolerance, simplifyTolerance=0):
+    """Combine clipped graph parts into one graph, joining them at seams.
+
+    Each part is a (nodes, edges, keepLabels) tuple as produced by
+    _clipGraph. Parts with keepLabels set retain their node ids; all other
+    nodes are numbered after the largest kept id.
+    """
+    kept = [n for nodes, _, keep in parts if keep for n, _ in nodes]
+    labels = count(int(max(kept)) + 1 if kept else 0)
+    DG = nx.MultiDiGraph()
+    seams = []
+    for part, (nodes, edges, keep) in enumerate(parts):
+        mapping = {}
+        for n, data in nodes:
+            mapping[n] = n if keep else next(labels)
+            DG.add_node(mapping[n], **data)
+        for u, v, data in edges:
+            ends = []
+            for n in (u, v):
+                if n not in mapping:
+                    mapping[n] = next(labels)
+                    DG.add_node(mapping[n], x=n.x, y=n.y, geom=Point(n.x, n.y))
+                    seams.append((mapping[n], part))
+                ends.append(mapping[n])
+            DG.add_edge(ends[0], ends[1], **data)
+    for node in _mergeSeams(DG, seams, tolerance):
+        _contractSeam(DG, node, simplifyTolerance)
+    return DG
+
+
+def _mergeSeams(DG, seams, tolerance):
+    """Collapse seam nodes that lie within tolerance of each other.
+
+    `seams` holds (node, part) pairs. Pieces of edge that run from seam to
+    seam within tolerance only graze a part, at a tile corner say, and are
+    dropped. The closest nodes are then joined first, but only while each
+    part has at most one edge into and one out of the joined node, so the
+    cut ends of neighbouring edges stay apart and each meets its
+    counterparts across the seam.
+    """
+    if not seams:
+        return []
+    parts = dict(seams)
+    parent = dict((n, n) for n in parts)
+
+    def find(n):
+        while parent[n] != n:
+            parent[n] = parent[parent[n]]
+            n = parent[n]
+        return n
+
+    for u, v, k, data in list(DG.edges(keys=True, data=True)):
+        if u in parts and v in parts and data['length'] <= tolerance:
+            DG.remove_edge(u, v, k)
+            a, b = sorted([find(u), find(v)])
+            parent[b] = a
+    ends = {}
+    for n in parts:
+        ends.setdefault(find(n), set()).update(
+            (parts[n], end) for end, degree in
+            (('in', DG.in_degree(n)), ('out', DG.out_degree(n))) if degree)
+
+    idx = index.Index((n, (DG.node[n]['x'], DG.node[n]['y']) * 2, None)
+                      for n in parts)
+    pairs = []
+    for n in sorted(parts):
+        p = DG.node[n]['geom']
+        for other in idx.intersection((p.x - tolerance, p.y - tolerance,
+                                       p.x + tolerance, p.y + tolerance)):
+            if other > n:
+                pairs.append((p.distance(DG.node[other]['geom']), n, other))
+    for _, n, other in sorted(pairs):
+        a, b = sorted([find(n), find(other)])
+        if a != b and not ends[a] & ends[b]:
+            parent[b] = a
+            ends[a] |= ends.pop(b)
+
+    clusters = {}
+    for n in parts:
+        clusters.setdefault(find(n), []).append(n)
+    for rep, members in sorted(clusters.items()):
+        x = sum(DG.node[n]['x'] for n in members) / float(len(members))
+        y = sum(DG.node[n]['y'] for n in members) / float(len(members))
+        members = set(members)
+        for n in members - {rep}:
+            for u, _, data in list(DG.in_edges(n, data=True)):
+                if u not in members:
+                    DG.add_edge(u, rep, **data)
+            for _, v, data in list(DG.out_edges(n, data=True)):
+                if v not in members:
+                    DG.add_edge(rep, v, **data)
+            DG.remove_node(n)
+        DG.node[rep].update(x=x, y=y, geom=Point(x, y))
+        for u, v, data in DG.in_edges(rep, data=True):
+            data['geom'] = LineString(list(data['geom'].coords[:-1]) + [(x, y)])
+            data['length'] = data['geom'].length
+        for u, v, data in DG.out_edges(rep, data=True):
+            data['geom'] = LineString([(x, y)] + list(data['geom'].coords[1:]))
+            data['length'] = data['geom'].length
+        if not DG.degree(rep):
+            DG.remove_node(rep)
+    return sorted(n for n in clusters if n in DG)
+
+
+def _contractSeam(DG, node, simplifyTolerance):
+    """Join the edges on either side of a seam node that just passes through."""
+    succ = list(DG.out_edges(node, keys=True, data=True))
+    pred = list(DG.in_edges(node, keys=True, data=True))
+    if len(succ) != 2 or len(pred) != 2:
+        return
+    (_, a, ka, ta), (_, b, kb, tb) = succ
+    if node in (a, b) or set(u for u, _, _, _ in pred) != {a, b}:
+        return
+    if a == b:
+        # A loop back to a; the twin of ta is the edge arriving from the
+        # side that ta leaves by.
+        fa, fb = [d for _, _, _, d in pred]
+        if _leaveDistance(fa, ta) > _leaveDistance(fb, ta):
+            fa, fb = fb, fa
+    else:
+        fa = [d for u, _, _, d in pred if u == a][0]
+        fb = [d for u, _, _, d in pred if u == b][0]
+    if any(d['terminal'] for d in (ta, tb, fa, fb)):
+        return
+    DG.add_edge(a, b, **_joinEdges(fa, tb, simplifyTolerance))
+    DG.add_edge(b, a, **_joinEdges(fb, ta, simplifyTolerance))
+    DG.remove_node(node)
+
+
+def _leaveDistance(first, second):
+    """Distance between the last step of first and the first of second."""
+    return Point(first['geom'].coords[-2]).distance(
+        Point(second['geom'].coords[1]))
+
+
+def _joinEdges(first, second, simplifyTolerance):
+    coords = list(first['geom'].coords) + list(second['geom'].coords)[1:]
+    geom = LineString(coords).simplify(simplifyTolerance)
+    return dict(first, geom=geom, length=geom.length, terminal=False)
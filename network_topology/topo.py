@@ -5,8 +5,10 @@ from triangle import triangulate
 from shapely.geometry import LineString, Point, Polygon, MultiPolygon, mapping
 from shapely.ops import cascaded_union
 from itertools import combinations
+from collections import OrderedDict
+import math
+import multiprocessing
 import numpy as np
-import random
 from rtree import index
 import logging
 import json
@@ -15,47 +17,133 @@ from shapely.ops import transform
 from functools import partial
 import os
 
+from .instrument import PipelineStats
+from .stagecache import StageCache
+
 logger = logging.getLogger('network-topology')
-logger.setLevel(logging.INFO)
-ch = logging.StreamHandler()
-logger.addHandler(ch)
+logger.addHandler(logging.NullHandler())
+
+# Buffered lines are unioned in groups that fall in the same grid cell;
+# cells are this many times the line thickness across.
+UNION_CELL_SIZE = 500.
+
+# Feature template for the line-delimited debug dumps.
+_DUMP_FEATURE = ('{"type": "Feature", "properties": {"stroke-opacity": 0.25}, '
+                 '"geometry": {"type": "Polygon", "coordinates": [[%s]]}}\n')
 
 
 def getNetworkTopology(lineStrings, thickness=14.0, splitAtTeriminals=None,
                        turnThreshold=20.0, minInnerPerimeter=200,
-                       debugFolder=None):
-    """Generate a bidirectional graph of the topology created by the lines."""
-    # Make buffered shape
-    big_shape = _makeBufferedShape(lineStrings, thickness, minInnerPerimeter)
-    if debugFolder:
-        _dumpBigShape(big_shape, debugFolder)
-
-    triangles = _triangulate(big_shape, lineStrings, thickness,
-                             minInnerPerimeter)
-    if debugFolder:
-        _dumpTriangles(triangles, debugFolder)
-
-    polygons = _polygonize(triangles, big_shape)
-    if debugFolder:
-        _dumpPolygons(polygons, triangles, debugFolder)
-
-    poly_graph = _buildInitialGraph(polygons)
-    _tidyIntersections(poly_graph, triangles, polygons)
-    skel_graph = _buildSkeletonGraph(poly_graph, triangles, polygons)
-    if splitAtTeriminals:
-        _insertAtTerminals(skel_graph, splitAtTeriminals)
-    graph = _simplifyGraph(skel_graph, turnThreshold, thickness/100.0)
+                       debugFolder=None, chunkSize=10000, workers=1,
+                       cacheFolder=None, stats=None):
+    """Generate a bidirectional graph of the topology created by the lines.
+
+    `lineStrings` may be any iterable, such as a generator reading them from
+    disk; it is only consumed once. Lines are buffered and unioned
+    `chunkSize` at a time, so that memory use is bounded by the chunk size
+    and the size of the network rather than by the number of lines. With
+    `workers` other than 1, the union runs in a pool of that many processes
+    (all cores if None).
+
+    With a `cacheFolder`, the buffered shape, triangulation, polygons and
+    skeleton graph are kept there (see StageCache), and a later run on the
+    same lines with the same `thickness` and `minInnerPerimeter` resumes
+    from the last of them that is cached. Only terminal insertion and
+    simplification, which use `splitAtTeriminals` and `turnThreshold`, are
+    then repeated. The lines are hashed first, so a one-shot iterator is
+    held in memory in this case.
+
+    A PipelineStats given as `stats` gets a record for each stage that
+    runs: 'buffer', 'triangulate', 'polygonize', 'skeleton' and 'simplify'.
+    """
+    if stats is None:
+        stats = PipelineStats()
+    cache = key = None
+    if cacheFolder:
+        cache = StageCache(cacheFolder)
+        lineStrings, key = cache.key(lineStrings, thickness,
+                                     minInnerPerimeter)
+
+    skel_graph = cache.load(key, 'skeleton') if cache else None
+    if skel_graph is None:
+        triangles = cache.load(key, 'triangles') if cache else None
+        if triangles is None:
+            shape = cache.load(key, 'shape') if cache else None
+            if shape is None:
+                with stats.stage('buffer') as record:
+                    # Make buffered shape
+                    shape = _makeBufferedShape(
+                        _counted(lineStrings, record, 'lines'), thickness,
+                        minInnerPerimeter, chunkSize, workers)
+                    record['endpoints'] = len(shape[1])
+                if cache:
+                    cache.save(key, 'shape', shape)
+            big_shape, endpoints = shape
+            if debugFolder:
+                _dumpBigShape(big_shape, debugFolder)
+
+            with stats.stage('triangulate') as record:
+                triangles = _triangulate(big_shape, endpoints, thickness,
+                                         minInnerPerimeter)
+                record['vertices'] = len(triangles['vertices'])
+                record['triangles'] = len(triangles['triangles'])
+            if cache:
+                cache.save(key, 'triangles', triangles)
+        if debugFolder:
+            _dumpTriangles(triangles, debugFolder)
+
+        polygons = cache.load(key, 'polygons') if cache else None
+        if polygons is None:
+            with stats.stage('polygonize') as record:
+                polygons = _polygonize(triangles)
+                record['polygons'] = len(polygons)
+            if cache:
+                cache.save(key, 'polygons', polygons)
+        if debugFolder:
+            _dumpPolygons(polygons, triangles, debugFolder)
+
+        with stats.stage('skeleton') as record:
+            poly_graph = _buildInitialGraph(triangles, polygons)
+            _tidyIntersections(poly_graph, triangles, polygons)
+            skel_graph = _buildSkeletonGraph(poly_graph, triangles, polygons)
+            record['nodes'] = skel_graph.number_of_nodes()
+            record['edges'] = skel_graph.number_of_edges()
+        if cache:
+            cache.save(key, 'skeleton', skel_graph)
+    with stats.stage('simplify') as record:
+        if splitAtTeriminals:
+            _insertAtTerminals(skel_graph, splitAtTeriminals)
+        graph = _simplifyGraph(skel_graph, turnThreshold, thickness/100.0)
+        record['nodes'] = graph.number_of_nodes()
+        record['edges'] = graph.number_of_edges()
     # _findSegmentsAndIntersections(skel_graph, turnThreshold)
     return graph
 
 
-def _makeBufferedShape(lineStrings, thickness=14.0, minInnerPerimeter=200):
+def _counted(items, record, name):
+    """Yield items, keeping count of them in record[name]."""
+    record[name] = 0
+    for item in items:
+        record[name] += 1
+        yield item
+
+
+def _makeBufferedShape(lineStrings, thickness=14.0, minInnerPerimeter=200,
+                       chunkSize=10000, workers=1):
+    """Return the filled, simplified union of the buffered lines.
+
+    Also returns the distinct endpoints of the lines, in input order.
+    """
     logger.info('Creating buffered shape')
-    bufferedShapes = []
-    buf = thickness / 2.0
-    for ls in lineStrings:
-        bufferedShapes.append(ls.buffer(buf, resolution=2, join_style=3))
-    big_shape = cascaded_union(bufferedShapes)
+    endpoints = OrderedDict()
+    pool = multiprocessing.Pool(workers) if workers != 1 else None
+    try:
+        big_shape = _unionBuffers(lineStrings, thickness, chunkSize,
+                                  endpoints, pool)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
     if big_shape.geom_type == 'MultiPolygon':
         filled_shape = MultiPolygon([[g.exterior.coords,
                                      [ring.coords for ring in g.interiors
@@ -67,141 +155,316 @@ def _makeBufferedShape(lineStrings, thickness=14.0, minInnerPerimeter=200):
                                 if ring.length > minInnerPerimeter])
     bs = filled_shape.simplify(thickness/10.0)
     logger.info('Completed buffered shape')
-    return bs
+    return bs, list(endpoints)
+
 
+def _unionBuffers(lineStrings, thickness, chunkSize, endpoints, pool=None):
+    """Buffer the lines and return the union of the buffers.
 
-def _triangulate(big_shape, lineStrings, thickness=14.0, minInnerPerimeter=200):
+    Each full chunk of buffers is unioned into per grid cell partial shapes
+    straight away; inputs that fit in one chunk are unioned in one go
+    unless there is a pool. With a pool, the cells are unioned in parallel
+    and then merged in a quadtree, four neighbouring cells at a time.
+    """
+    cells = {}
+    cellSize = UNION_CELL_SIZE * thickness
+    bufferedShapes = []
+    buf = thickness / 2.0
+    for ls in lineStrings:
+        if ls.geom_type == 'LineString':
+            geoms = [ls]
+        else:
+            geoms = ls.geoms
+        for geom in geoms:
+            for i in [0, -1]:
+                endpoints[geom.coords[i][:2]] = None
+        bufferedShapes.append(ls.buffer(buf, resolution=2, join_style=3))
+        if len(bufferedShapes) >= chunkSize:
+            _unionByCell(bufferedShapes, cellSize, cells, pool)
+            bufferedShapes = []
+    if not cells and pool is None:
+        return cascaded_union(bufferedShapes)
+    _unionByCell(bufferedShapes, cellSize, cells, pool)
+    if pool is None:
+        return cascaded_union([cells[c] for c in sorted(cells)])
+    while len(cells) > 1:
+        # Count cells from 0, so that halving always brings them together;
+        # -1 // 2 would stay -1 and never join cell 0.
+        i0 = min(i for i, j in cells)
+        j0 = min(j for i, j in cells)
+        groups = {}
+        for (i, j), shape in cells.items():
+            groups.setdefault(((i - i0) // 2, (j - j0) // 2),
+                              []).append(shape)
+        cells = _unionGroups(groups, pool)
+    return list(cells.values())[0] if cells else cascaded_union([])
+
+
+def _unionByCell(shapes, cellSize, cells, pool=None):
+    """Union shapes into the partial shape of the grid cell they centre on."""
+    groups = {}
+    for shape in shapes:
+        minx, miny, maxx, maxy = shape.bounds
+        cell = (int(math.floor((minx + maxx) / 2.0 / cellSize)),
+                int(math.floor((miny + maxy) / 2.0 / cellSize)))
+        groups.setdefault(cell, []).append(shape)
+    for cell, group in groups.items():
+        if cell in cells:
+            group.append(cells[cell])
+    cells.update(_unionGroups(groups, pool))
+
+
+def _unionGroups(groups, pool=None):
+    """Return the union of each group of shapes, under the same keys."""
+    keys = sorted(groups)
+    if pool is None:
+        shapes = [cascaded_union(groups[k]) for k in keys]
+    else:
+        shapes = pool.map(cascaded_union, [groups[k] for k in keys])
+    return dict(zip(keys, shapes))
+
+
+class _VertexRegistry(object):
+    """Deduplicated triangulation vertices, keyed by their coordinates."""
+
+    def __init__(self):
+        """Initialize an empty registry."""
+        self.lookup = {}
+        self.coords = []
+
+    def add(self, x, y):
+        """Return the index of vertex (x, y), registering it if it is new."""
+        key = (x, y)
+        i = self.lookup.get(key)
+        if i is None:
+            i = len(self.coords)
+            self.lookup[key] = i
+            self.coords.append(key)
+        return i
+
+    def addRing(self, coords):
+        """Register the vertices of a ring and return its segment array."""
+        pts = np.asarray(coords, dtype=float)[:, :2]
+        add = self.add
+        ids = np.fromiter((add(x, y) for x, y in pts.tolist()),
+                          dtype=np.int32, count=len(pts))
+        segments = np.column_stack([ids[:-1], ids[1:]])
+        return segments[segments[:, 0] != segments[:, 1]]
+
+    def vertices(self):
+        """All registered vertices as an (n, 2) array."""
+        return np.array(self.coords, dtype=float).reshape(-1, 2)
+
+
+def _triangulate(big_shape, endpoints, thickness=14.0, minInnerPerimeter=200):
     logger.info('Reticulating shape')
-    tri = {
-        'vertices': [],
-        'segments': []
-        }
+    registry = _VertexRegistry()
+    segments = []
+    holes = []
     if big_shape.geom_type == 'MultiPolygon':
         geoms = big_shape.geoms
     else:
         geoms = [big_shape]
     for shape in geoms:
-        lastIndex = len(tri['vertices'])
-        tri['vertices'].append(list(shape.exterior.coords[0]))
-        for x, y in shape.exterior.coords[1:]:
-            if [x, y] in tri['vertices']:
-                currentIndex = tri['vertices'].index([x, y])
-            else:
-                currentIndex = len(tri['vertices'])
-                tri['vertices'].append([x, y])
-            tri['segments'].append([lastIndex, currentIndex])
-            lastIndex = currentIndex
-
-        if shape.interiors and 'holes' not in tri:
-            tri['holes'] = []
+        segments.append(registry.addRing(shape.exterior.coords))
         for ring in shape.interiors:
             if ring.length > minInnerPerimeter:
-                x, y = 0, 0
-                minx, miny, maxx, maxy = ring.bounds
-                while not Polygon(ring).contains(Point(x, y)):
-                    x = random.uniform(minx, maxx)
-                    y = random.uniform(miny, maxy)
-                tri['holes'].append([x, y])
-                lastIndex = len(tri['vertices'])
-                tri['vertices'].append(list(ring.coords[0]))
-                for x, y in ring.coords[1:]:
-                    if [x, y] in tri['vertices']:
-                        currentIndex = tri['vertices'].index([x, y])
-                    else:
-                        currentIndex = len(tri['vertices'])
-                        tri['vertices'].append([x, y])
-                    tri['segments'].append([lastIndex, currentIndex])
-                    lastIndex = currentIndex
+                # representative_point is guaranteed to fall inside the ring
+                # and, unlike random sampling, is the same on every run.
+                holes.append(Polygon(ring).representative_point().coords[0])
+                segments.append(registry.addRing(ring.coords))
 
-    for ls in lineStrings:
-        if ls.geom_type == 'LineString':
-            geoms = [ls]
-        else:
-            geoms = ls.geoms
-        for geom in geoms:
-            for i in [0, -1]:
-                coords = list(geom.coords[i])
-                if coords not in tri['vertices']:
-                    tri['vertices'].append(coords)
-    tri = triangulate(tri, 'pq0Da{}i'.format(thickness**2.0))
+    for x, y in endpoints:
+        registry.add(x, y)
+
+    tri = {
+        'vertices': registry.vertices(),
+        'segments': np.concatenate(segments) if segments
+        else np.zeros((0, 2), dtype=np.int32)
+        }
+    if holes:
+        tri['holes'] = np.array(holes, dtype=float)
+    tri = triangulate(tri, 'pq0Da{}in'.format(thickness**2.0))
     logger.info('Reticulating complete')
     return tri
 
 
-def _polygonize(res, big_shape):
+def _polygonize(res):
+    """Merge the triangles around each interior vertex into polygons.
+
+    Triangles sharing a vertex that is not on a segment are joined, with
+    union-find, into clusters. Each cluster becomes one polygon, traced
+    along the cluster's boundary edges as found from the triangle
+    neighbours. Triangles with no interior vertex are returned as they are,
+    followed by the polygons.
+    """
     logger.info('Removing internal nodes')
-    interior_pts = {}
-    for i, v in enumerate(res['vertex_markers']):
-        if v == 0:
-            interior_pts[i] = []
-    for tri, pts in enumerate(res['triangles']):
-        for p in pts:
-            if p in interior_pts:
-                interior_pts[p].append(tri)
-    connectivity_graph = nx.Graph()
-    for tris in interior_pts.values():
-        if len(tris) > 0:
-            for tri in tris[1:]:
-                connectivity_graph.add_edge(tris[0], tri)
+    triangles = res['triangles']
+    neighbors = res['neighbors']
+    vertices = res['vertices']
+    interior = res['vertex_markers'].ravel() == 0
+    onInterior = interior[triangles]
+
+    tris, corners = np.nonzero(onInterior)
+    verts = triangles[tris, corners]
+    order = np.lexsort((tris, verts))
+    tris, verts = tris[order].tolist(), verts[order].tolist()
+    parent = list(range(len(triangles)))
+
+    def find(t):
+        while parent[t] != t:
+            parent[t] = parent[parent[t]]
+            t = parent[t]
+        return t
+
+    # Clusters are numbered in order of their lowest interior vertex.
+    roots = {}
+    firsts = []
+    for i, (t, v) in enumerate(zip(tris, verts)):
+        if i == 0 or verts[i - 1] != v:
+            firsts.append(t)
+            first = t
+        else:
+            a, b = find(first), find(t)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+    for t in firsts:
+        roots.setdefault(find(t), len(roots))
+    label = np.full(len(triangles), -1, dtype=int)
+    clustered = np.flatnonzero(onInterior.any(axis=1))
+    label[clustered] = [roots[find(t)] for t in clustered.tolist()]
+
+    # Triangles are counterclockwise, so the boundary edges of a cluster,
+    # taken in the direction of their triangle, run around it.
+    starts, ends, owners = [], [], []
+    for k in range(3):
+        across = neighbors[clustered, k]
+        edge = (across < 0) | (label[np.maximum(across, 0)] !=
+                               label[clustered])
+        starts.append(triangles[clustered[edge], (k + 1) % 3])
+        ends.append(triangles[clustered[edge], (k + 2) % 3])
+        owners.append(label[clustered[edge]])
+    starts, ends, owners = [np.concatenate(e) for e in (starts, ends, owners)]
+    order = np.argsort(owners, kind='mergesort')
+    starts, ends = starts[order].tolist(), ends[order].tolist()
+    bounds = np.searchsorted(owners[order], np.arange(len(roots) + 1))
+
     polys = []
-    for cluster in list(nx.connected_components(connectivity_graph)):
-        shape_graph = nx.Graph()
-        for tri in cluster:
-            for v1, v2 in zip(res['triangles'][tri],
-                              list(res['triangles'][tri][1:]) +
-                              [res['triangles'][tri][0]]):
-                if v1 not in interior_pts and v2 not in interior_pts:
-                    shape_graph.add_edge(v1, v2)
-
-        poly = []
-        pt = shape_graph.nodes().keys()[0]
-        while pt not in poly:
-            poly.append(pt)
-            for neighbour in shape_graph.neighbors(pt):
-                if neighbour not in poly and len(shape_graph[neighbour]) != 1:
-                    pt = neighbour
-                    break
-        polys.append(poly)
-    remaining_triangles = [list(vs) for i, vs in enumerate(res['triangles'])
-                           if i not in connectivity_graph]
+    for c in range(len(roots)):
+        succ = OrderedDict()
+        for i in range(bounds[c], bounds[c + 1]):
+            succ.setdefault(starts[i], []).append(ends[i])
+        polys.append(_outerBoundary(succ, vertices))
+    remaining_triangles = triangles[label < 0].tolist()
     return remaining_triangles + polys
 
 
-def _mergeShapes(cluster, TG, polys):
-    combined_graph = nx.Graph()
-    for shape in cluster:
-        if len(polys[shape]) == 0:
+def _outerBoundary(succ, vertices):
+    """Return the loop of directed boundary edges enclosing the most area.
+
+    `succ` maps each vertex to the ends of the boundary edges leaving it,
+    and is used up. Each connected set of edges is walked into one closed
+    loop with Hierholzer's algorithm, starting from the lowest vertex, so
+    a boundary that touches itself is kept whole, passing through the
+    vertex it touches at twice. Holes run clockwise and have negative
+    area, so the loop kept is the outer boundary.
+    """
+    lowest = min(succ, key=lambda v: (vertices[v][0], vertices[v][1]))
+    best, bestArea = None, None
+    for start in [lowest] + list(succ):
+        if not succ[start]:
             continue
-        for p1, p2 in zip(polys[shape], polys[shape][1:] + [polys[shape][0]]):
-            if combined_graph.has_edge(p1, p2):
-                combined_graph.remove_edge(p1, p2)
-                if not combined_graph[p1]:
-                    combined_graph.remove_node(p1)
-                if not combined_graph[p2]:
-                    combined_graph.remove_node(p2)
+        stack = [start]
+        loop = []
+        while stack:
+            pt = stack[-1]
+            if succ[pt]:
+                stack.append(succ[pt].pop())
             else:
-                combined_graph.add_edge(p1, p2)
-    poly = []
-    pt = combined_graph.nodes().keys()[0]
-    while pt not in poly:
-        poly.append(pt)
-        for neighbour in combined_graph.neighbors(pt):
-            if neighbour not in poly:
-                pt = neighbour
-                break
-    cluster = list(cluster)
-    base = cluster[0]
-    polys[base] = poly
-    for shape in cluster[1:]:
-        polys[shape] = []
-        if shape in TG:
-            for n, d in TG[shape].iteritems():
-                if n != base:
-                    TG.add_edge(base, n, **d)
-            TG.remove_node(shape)
-
-
-def _buildInitialGraph(polys):
+                loop.append(stack.pop())
+        loop = loop[-1:0:-1]
+        xy = vertices[loop]
+        area = np.dot(xy[:, 0], np.roll(xy[:, 1], -1)) - \
+            np.dot(xy[:, 1], np.roll(xy[:, 0], -1))
+        if best is None or area > bestArea:
+            best, bestArea = loop, area
+    return best
+
+
+def _groupPairs(pairs):
+    """Group pairs of shapes into clusters with union-find.
+
+    Clusters, and the shapes in each, are listed in order of first
+    appearance, so the first shape of a cluster is from its first pair.
+    """
+    parent = {}
+
+    def find(n):
+        while parent[n] != n:
+            parent[n] = parent[parent[n]]
+            n = parent[n]
+        return n
+
+    order = []
+    for pair in pairs:
+        for n in pair:
+            if n not in parent:
+                parent[n] = n
+                order.append(n)
+        a, b = find(pair[0]), find(pair[1])
+        if a != b:
+            parent[b] = a
+    clusters = OrderedDict()
+    for n in order:
+        clusters.setdefault(find(n), []).append(n)
+    return list(clusters.values())
+
+
+def _mergeShapes(clusters, TG, polys, vertices):
+    """Merge each cluster of shapes into its first shape, in one pass.
+
+    Edges of TG to the other shapes of a cluster are moved to the first
+    one, which is given the traced boundary of the whole cluster.
+    """
+    base = {}
+    for cluster in clusters:
+        for shape in cluster:
+            base[shape] = cluster[0]
+        polys[cluster[0]] = _traceBoundary(cluster, polys, vertices)
+    merged = []
+    for cluster in clusters:
+        for shape in cluster[1:]:
+            polys[shape] = []
+            if shape not in TG:
+                continue
+            for n, d in TG[shape].items():
+                n = base.get(n, n)
+                if n != cluster[0]:
+                    TG.add_edge(cluster[0], n, **d)
+            merged.append(shape)
+    TG.remove_nodes_from(merged)
+
+
+def _traceBoundary(cluster, polys, vertices):
+    """Return the outline of the union of the shapes in a cluster.
+
+    The shapes run counterclockwise, so an edge shared by two of them is
+    used once each way, and is interior. The other edges are walked with
+    _outerBoundary, which keeps the outer loop rather than a hole.
+    """
+    counts = OrderedDict()
+    for shape in cluster:
+        ring = polys[shape]
+        for edge in zip(ring, ring[1:] + ring[:1]):
+            counts[edge] = counts.get(edge, 0) + 1
+    succ = OrderedDict()
+    for (p1, p2), n in counts.items():
+        for _ in range(n - counts.get((p2, p1), 0)):
+            succ.setdefault(p1, []).append(p2)
+    return _outerBoundary(succ, vertices)
+
+
+def _buildInitialGraph(res, polys):
     logger.info('Build polygon graph')
     edge_tri = {}
     TG = nx.Graph()
@@ -220,12 +483,10 @@ def _buildInitialGraph(polys):
         add_edge(t[0], t[-1], i, edge_tri, TG)
 
     # Collapse internal edges
-    central_shapes = [t for t in TG.nodes() if len(TG[t]) > 2]
-    SG = TG.subgraph(central_shapes)
-    clusters = list(nx.connected_components(SG))
-
-    for cluster in clusters:
-        _mergeShapes(cluster, TG, polys)
+    central = set(t for t in TG.nodes() if len(TG[t]) > 2)
+    _mergeShapes(_groupPairs((t1, t2) for t1, t2 in TG.edges()
+                             if t1 in central and t2 in central),
+                 TG, polys, res['vertices'])
 
     logger.info('Polygon graph complete')
     return TG
@@ -234,35 +495,36 @@ def _buildInitialGraph(polys):
 def _tidyIntersections(TG, res, polys):
     logger.info('Tyding intersections')
     # 'Tyding T-intersections...'
+    vertices = res['vertices']
+    nodes = [n for n in TG.nodes()
+             if TG.degree(n) == 3 and len(polys[n]) == 3]
+    corners = np.array([polys[n] for n in nodes], dtype=int).reshape(-1, 3)
+    centres, r2 = _circumcircles(vertices[corners])
+
+    pairs = []
+    far = []
+    rings = []
+    for k, node in enumerate(nodes):
+        TG.node[node]['centroid'] = centres[k].tolist()
+        for neighbour, data in TG[node].items():
+            points = list(polys[neighbour])
+            rings.append(points[:])
+            points.remove(data['v1'])
+            points.remove(data['v2'])
+            pairs.append((k, node, neighbour))
+            far.append(points[0])
+
     toMerge = []
-    for node in TG.nodes():
-        if TG.degree(node) == 3 and len(polys[node]) == 3:
-            points = res['vertices'][polys[node]]
-            A = np.array([[p[0]*p[0] + p[1]*p[1], p[0], p[1], 1]
-                          for p in points])
-            M11 = np.linalg.det(A[:, [1, 2, 3]])
-            M12 = np.linalg.det(A[:, [0, 2, 3]])
-            M13 = np.linalg.det(A[:, [0, 1, 3]])
-            M14 = np.linalg.det(A[:, [0, 1, 2]])
-            x = 0.5 * M12/M11
-            y = -0.5 * M13/M11
-            r2 = M14/M11 + x*x + y*y
-            TG.node[node]['centroid'] = [x, y]
-            centroid = Point(x,y)
-
-            for neighbour, data in TG[node].iteritems():
-                points = list(polys[neighbour])
-                poly = Polygon([res['vertices'][p] for p in points])
-                points.remove(data['v1'])
-                points.remove(data['v2'])
-                point = res['vertices'][points[0]]
-                dx = x - point[0]
-                dy = y - point[1]
-                if dx*dx + dy*dy < 4*r2 or poly.contains(centroid):
-                    toMerge.append([node, neighbour])
-
-    for cluster in toMerge:
-        _mergeShapes(cluster, TG, polys)
+    if pairs:
+        k = np.array([pair[0] for pair in pairs], dtype=int)
+        d = centres[k] - vertices[np.array(far, dtype=int)]
+        near = (d * d).sum(axis=1) < 4 * r2[k]
+        inside = _ringsContain(vertices, rings, centres[k])
+        for (_, node, neighbour), merge in zip(pairs, near | inside):
+            if merge:
+                toMerge.append([node, neighbour])
+
+    _mergeShapes(_groupPairs(toMerge), TG, polys, vertices)
 
     logger.info('Tyding complete')
     # 'Cleaning up angled crossings...'
@@ -280,6 +542,43 @@ def _tidyIntersections(TG, res, polys):
     #     _mergeShapes(cluster, TG, polys)
 
 
+def _circumcircles(triangles):
+    """Return the circumcentres and squared radii of (n, 3, 2) triangles."""
+    # Work relative to the first vertex, to keep precision with large
+    # projected coordinates.
+    origin = triangles[:, 0]
+    b = triangles[:, 1] - origin
+    c = triangles[:, 2] - origin
+    b2 = (b * b).sum(axis=1)
+    c2 = (c * c).sum(axis=1)
+    d = 2.0 * (b[:, 0] * c[:, 1] - b[:, 1] * c[:, 0])
+    ux = (c[:, 1] * b2 - b[:, 1] * c2) / d
+    uy = (b[:, 0] * c2 - c[:, 0] * b2) / d
+    return origin + np.column_stack([ux, uy]), ux * ux + uy * uy
+
+
+def _ringsContain(vertices, rings, points):
+    """Test whether each point lies inside the matching ring of vertex ids.
+
+    Uses the even-odd rule, with a ray cast along +x from every point.
+    """
+    counts = np.array([len(ring) for ring in rings], dtype=int)
+    ids = np.concatenate([np.asarray(ring, dtype=int) for ring in rings])
+    owner = np.repeat(np.arange(len(rings)), counts)
+    starts = np.cumsum(counts) - counts
+    nxt = np.arange(len(ids)) + 1
+    nxt[starts + counts - 1] = starts
+    a = vertices[ids]
+    b = vertices[ids[nxt]]
+    px, py = points[owner, 0], points[owner, 1]
+    spans = (a[:, 1] > py) != (b[:, 1] > py)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cross = (a[:, 0] + (py - a[:, 1]) * (b[:, 0] - a[:, 0]) /
+                 (b[:, 1] - a[:, 1]))
+    hits = spans & (px < cross)
+    return np.bincount(owner, weights=hits, minlength=len(rings)) % 2 == 1
+
+
 def _makeKey(t1, t2):
     t1, t2 = sorted([t1, t2])
     return int(t1 * 1e9 + t2)
@@ -362,15 +661,22 @@ def _insertAtTerminals(G, points):
 
 
 def _simplifyGraph(G, turnThreshold=20.0, simplifyTolerance=0):
+    """Contract chains of pass-through nodes into single edges.
+
+    A node passes through if it has two neighbours, no turn sharper than
+    turnThreshold and no terminal edges. Every chain of such nodes is
+    walked once from each end, and each walk becomes one directed edge
+    whose 'nnodes' lists the skeleton nodes along it. A ring made only of
+    pass-through nodes is kept as loops on its first node.
+    """
     logger.info('Simplifying graph')
-    DG = nx.MultiDiGraph()
     threshold = np.cos(turnThreshold/180.0*np.pi)
-    for node in G.nodes():
-        if node not in DG:
-            DG.add_node(node, x=G.node[node]['x'], y=G.node[node]['y'])
-        else:
-            DG.node[node]['x'] = G.node[node]['x']
-            DG.node[node]['y'] = G.node[node]['y']
+    nodes = list(G.nodes())
+    through = set()
+    attrs = {}
+    DG = nx.MultiDiGraph()
+    for node in nodes:
+        attrs[node] = {'x': G.node[node]['x'], 'y': G.node[node]['y']}
         if len(G[node]) == 2:
             normals = []
             for neighbour in G[node]:
@@ -378,87 +684,100 @@ def _simplifyGraph(G, turnThreshold=20.0, simplifyTolerance=0):
                 normals.append(n)
             dp = -(normals[0][0] * normals[1][0] +
                    normals[0][1] * normals[1][1])
-            DG.node[node]['turn'] = dp < threshold
+            attrs[node]['turn'] = dp < threshold
+            if not attrs[node]['turn'] and not any(
+                    d['terminal'] for d in G[node].values()):
+                through.add(node)
         if 'terminal' in G.node[node]:
-            DG.node[node]['terminal'] = True
+            attrs[node]['terminal'] = True
+        if node not in through:
+            DG.add_node(node, **attrs[node])
+    visited = set()
+
+    def walk(start, neighbour):
+        path = [start, neighbour]
+        while path[-1] in through and path[-1] not in DG:
+            prev, cur = path[-2], path[-1]
+            visited.add(cur)
+            path.append([n for n in G[cur] if n != prev][0])
+        return path
+
+    def addChains(node):
         for neighbour in G[node]:
-            DG.add_edge(node, neighbour, nnodes=[node, neighbour],
+            path = walk(node, neighbour)
+            DG.add_edge(node, path[-1], nnodes=path,
                         terminal=G[node][neighbour]['terminal'])
-    to_remove = []
-    for node in DG.nodes():
-        if len(DG.edges(node)) == 2 and not DG.node[node]['turn'] and node not in DG.neighbors(node):
-            (x, n1), (x, n2) = DG.edges(node)
-            if DG[node][n1][0]['terminal'] or DG[node][n2][0]['terminal']:
-                continue
-            seq = DG[n1][node][0]['nnodes'] + DG[node][n2][0]['nnodes'][1:]
-            DG.add_edge(n1, n2, nnodes=seq, terminal=False)
-            DG.add_edge(n2, n1, nnodes=list(reversed(seq)), terminal=False)
-            to_remove.append(node)
-            DG.remove_edge(n1, node)
-            DG.remove_edge(node, n1)
-            DG.remove_edge(n2, node)
-            DG.remove_edge(node, n2)
-        #if 'terminal' in DG.node[node]:
-        #    to_remove.append(node)
-    for node in to_remove:
-        DG.remove_node(node)
-    for s, t, data in DG.edges(data=True):
-        coords = []
-        for node in data['nnodes']:
-            coords.append((G.node[node]['x'], G.node[node]['y']))
-        ls = LineString(coords).simplify(simplifyTolerance)
+
+    for node in list(DG.nodes()):
+        addChains(node)
+    # Whatever is left are rings with no node to start from.
+    for node in nodes:
+        if node in through and node not in visited:
+            DG.add_node(node, **attrs[node])
+            visited.add(node)
+            addChains(node)
+
+    edges = list(DG.edges(data=True))
+    index = dict((n, i) for i, n in enumerate(nodes))
+    xy = np.array([[G.node[n]['x'], G.node[n]['y']] for n in nodes],
+                  dtype=float).reshape(-1, 2)
+    counts = [len(data['nnodes']) for _, __, data in edges]
+    ids = np.array([index[n] for _, __, data in edges
+                    for n in data['nnodes']], dtype=int)
+    coords = np.split(xy[ids], np.cumsum(counts)[:-1]) if edges else []
+    for (s, t, data), c in zip(edges, coords):
+        ls = LineString(c).simplify(simplifyTolerance)
         data['geom'] = ls
         data['length'] = ls.length
     for node, data in DG.nodes(data=True):
-        data['geom'] = Point(G.node[node]['x'], G.node[node]['y'])
+        data['geom'] = Point(data['x'], data['y'])
     logger.info('Simplificaiton complete')
     return DG
 
 
+def _toLonLat(x):
+    """Return a function taking x and y arrays to longitude and latitude.
+
+    The UTM zone is picked from the x coordinate `x`, as the dumps always
+    have done.
+    """
+    zone = (int((x + 180)/6) % 60) + 1
+    utm = pyproj.Proj(proj='utm', zone=zone, ellps='WGS84')
+    if hasattr(pyproj, 'Transformer'):
+        return pyproj.Transformer.from_proj(utm, utm.to_latlong(),
+                                            always_xy=True).transform
+    return partial(utm, inverse=True)
+
+
+def _vertexStrings(triangles):
+    """Return the GeoJSON position of every vertex, formatted once."""
+    vertices = triangles['vertices']
+    lon, lat = _toLonLat(vertices[0][0])(vertices[:, 0], vertices[:, 1])
+    return ['[%.9f, %.9f]' % p for p in zip(lon.tolist(), lat.tolist())]
+
+
 def _dumpBigShape(big_shape, debugFolder):
-    zone = (int((big_shape.exterior.coords[0][0] + 180)/6) % 60) + 1
-    utm17 = pyproj.Proj(proj='utm', zone=zone, ellps='WGS84')
-    google = pyproj.Proj(init='epsg:4326')
-    project = partial(pyproj.transform, utm17, google)
+    project = _toLonLat(big_shape.exterior.coords[0][0])
     with open(os.path.join(debugFolder, 'bigshape.geojson'), 'w') as fp:
         json.dump(mapping(transform(project, big_shape)), fp)
 
 
 def _dumpTriangles(triangles, debugFolder):
-    zone = (int((triangles['vertices'][0][0] + 180)/6) % 60) + 1
-    utm17 = pyproj.Proj(proj='utm', zone=zone, ellps='WGS84')
-    features = []
-    for vs in triangles['triangles']:
-        coord_list = [list(utm17(inverse=True,
-                                 *triangles['vertices'][v])) for v in vs]
-        features.append({"type": "Feature",
-                         "properties": {'stroke-opacity': 0.25},
-                         "geometry": {
-                            "type": "Polygon",
-                            "coordinates": [coord_list]
-                         }})
-    data = {"type": "FeatureCollection",
-            "features": features}
-    with open(os.path.join(debugFolder, 'triangles.geojson'), 'w') as fp:
-        json.dump(data, fp)
+    """Write the triangles as line-delimited GeoJSON polygons."""
+    _dumpRings(triangles['triangles'].tolist(), _vertexStrings(triangles),
+               os.path.join(debugFolder, 'triangles.geojsonl'))
 
 
 def _dumpPolygons(polygons, triangles, debugFolder):
-    zone = (int((triangles['vertices'][0][0] + 180)/6) % 60) + 1
-    utm17 = pyproj.Proj(proj='utm', zone=zone, ellps='WGS84')
-    features = []
-    for vs in polygons:
-        coord_list = [list(utm17(inverse=True,
-                      *triangles['vertices'][v])) for v in vs]
-        if not coord_list:
-            continue
-        features.append({"type": "Feature",
-                         "properties": {'stroke-opacity': 0.25},
-                         "geometry": {
-                            "type": "Polygon",
-                            "coordinates": [coord_list]
-                         }})
-    data = {"type": "FeatureCollection",
-            "features": features}
-    with open(os.path.join(debugFolder, 'polygons.geojson'), 'w') as fp:
-        json.dump(data, fp)
+    """Write the polygons as line-delimited GeoJSON polygons."""
+    _dumpRings(polygons, _vertexStrings(triangles),
+               os.path.join(debugFolder, 'polygons.geojsonl'))
+
+
+def _dumpRings(rings, points, path):
+    with open(path, 'w') as fp:
+        for ring in rings:
+            if not len(ring):
+                continue
+            fp.write(_DUMP_FEATURE % ', '.join(
+                [points[v] for v in ring] + [points[ring[0]]]))
@@ -0,0 +1,69 @@
+"""Module for updating a built network topology after routes change."""
+
+from shapely.geometry import Point, box
+from shapely.ops import cascaded_union
+from shapely.prepared import prep
+import logging
+
+from .topo import getNetworkTopology
+from .tiling import _assemble, _clipGraph, _lineParts, _totalBounds
+
+logger = logging.getLogger('network-topology')
+
+
+def updateNetworkTopology(DG, lineStrings, added=None, removed=None,
+                          overlap=None, thickness=14.0,
+                          splitAtTeriminals=None, turnThreshold=20.0,
+                          minInnerPerimeter=200):
+    """Update a graph from getNetworkTopology after routes have changed.
+
+    `lineStrings` is the full, updated set of linestrings, and `added` and
+    `removed` are the linestrings that changed since DG was built. Only the
+    region within `overlap` of the changed linestrings is rebuilt, from the
+    linestrings around it, and spliced into the rest of DG the same way as
+    tiles are by getTiledNetworkTopology. Nodes outside the region keep
+    their ids; new nodes are numbered after the largest of them. The other
+    parameters must match those DG was built with.
+    """
+    changed = list(added or []) + list(removed or [])
+    if not changed:
+        return DG.copy()
+    if overlap is None:
+        overlap = max(20.0 * thickness, minInnerPerimeter)
+    area = cascaded_union([box(*_grow(ls.bounds, overlap)) for ls in changed])
+    padded = area.buffer(overlap, join_style=2)
+    logger.info('Rebuilding topology around {} changed routes'.format(
+        len(changed)))
+
+    inArea = prep(area)
+    inPadded = prep(padded)
+    parts = []
+    for ls in lineStrings:
+        if inPadded.intersects(ls):
+            parts.extend(_lineParts(ls.intersection(padded)))
+    if parts:
+        points = [p for p in splitAtTeriminals or [] if inPadded.intersects(p)]
+        local = getNetworkTopology(parts, thickness=thickness,
+                                   splitAtTeriminals=points or None,
+                                   turnThreshold=turnThreshold,
+                                   minInnerPerimeter=minInnerPerimeter)
+        nodes, edges = _clipGraph(
+            local, area, lambda x, y: inArea.intersects(Point(x, y)))
+    else:
+        nodes, edges = [], []
+
+    geoms = [data['geom'] for _, __, data in DG.edges(data=True)] + [padded]
+    rest = box(*_grow(_totalBounds(geoms), thickness)).difference(area)
+    keptNodes, keptEdges = _clipGraph(
+        DG, rest, lambda x, y: not inArea.intersects(Point(x, y)))
+
+    logger.info('Splicing rebuilt region')
+    graph = _assemble([(keptNodes, keptEdges, True), (nodes, edges, False)],
+                      thickness / 2.0, thickness / 100.0)
+    logger.info('Update complete')
+    return graph
+
+
+def _grow(bounds, margin):
+    minx, miny, maxx, maxy = bounds
+    return minx - margin, miny - margin, maxx + margin, maxy + margin